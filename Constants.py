@@ -13,6 +13,13 @@ Created on Wed Aug 14 11:58:25 2019
 MIN_DAMAGE=0.1 #minimum acceptable damage. Effects from smaller damage levels are neglected
 CRIT_DAMAGE=0.9 #critical damage level. A component fails if its damage level is larger or equal than this threshold
 EPS=1e-100 #epsilon constant for avoiding divisions by zero
+Z_95=1.959963984540054 #standard normal quantile for 95% confidence intervals
+OD_SAMPLES=30 #number of sampled source and consumer nodes in the evaluation of the loads (origin-destination betweenness)
+OD_RANDOM="random" #OD sampling of the loads: OD_SAMPLES random source and consumer nodes, drawn again in every evaluation
+OD_EXACT="exact" #OD sampling of the loads: all the source and consumer nodes
+OD_FIXED="fixed" #OD sampling of the loads: the first OD_SAMPLES source and consumer nodes in a fixed random order, the same in every evaluation
+OD_FIXED_SEED=0 #seed of the fixed order of the nodes with OD_FIXED
+IS_MAX_POF=0.5 #largest probability of failure to which importance sampling raises a component
 EDGES='edges'#keyword for edges in dictionary
 NODES='nodes'#keyword for nodes in dictionary
 
@@ -48,10 +55,13 @@ REACTANCE="Reactance"
 WEIGHT='WEIGHT'#this property is added in code
 LINE_DAMAGE='DAM'#this property is added in code
 LINE_DELTADAMAGE='DDAM'#this property is added in code
+LINE_POF="ProbFailure"#optional property (probability of failure of the line), only used with line fragility
 
 #Exposure areas geojson file
 AREA_NAME='Name' #keyword for area name (must coincide with name of a consumer node)
 AREA_POF="Prob_Disruption" #this property is added in code
+AREA_POF_CI_LOW="Prob_Disruption_CI_low" #this property is added in code (lower bound of the 95% confidence interval)
+AREA_POF_CI_HIGH="Prob_Disruption_CI_high" #this property is added in code (upper bound of the 95% confidence interval)
 AREA_POPULATION="population"
 
 # Network fragility json file
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Python module for the memoization of the Monte Carlo samples.
+Contains the FailureSetCache class:
+    - Keys: the set of components failed by the direct hazard action, as a bitset of the failed nodes (and lines)
+    - Values: the state of the consumer areas after the cascading effects (the outage vector of the sample)
+    - Bounds: least recently used entries are evicted above a number of entries or an estimated memory size
+    - Statistics: number of hits and misses, entries and memory, also of the caches of the worker processes
+The cascading effects of a failure set are simulated with a random stream derived from the set itself (see seed_sequence),
+so that a cached outage vector is the one that the simulation would give again.
+
+@author: hfrv2
+"""
+
+import collections
+import hashlib
+
+import numpy as np
+
+
+class FailureSetCache():
+    '''
+    LRU cache of the outage vectors of the consumer areas, keyed by the failure set of the direct hazard action.
+    '''
+
+    # estimated memory (bytes) of one entry besides its key and value (dict slot, bytes objects)
+    ENTRY_OVERHEAD = 200
+    # first word of the spawn keys of the cascade streams (the sample streams have a spawn key of length one)
+    CASCADE_STREAM = 1
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        # last reported number of entries and memory of the cache of each worker process
+        self._worker_sizes = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(node_failures, edge_failures=None):
+        '''
+        Returns the bitset of the failed nodes (followed by the one of the failed lines, if given) as bytes.
+        '''
+        key = np.packbits(node_failures).tobytes()
+        if edge_failures is not None:
+            key += np.packbits(edge_failures).tobytes()
+        return key
+
+    @classmethod
+    def seed_sequence(cls, parent, key):
+        '''
+        Returns the seed of the cascading effects of the failure set key, a child of the seed sequence of the simulation.
+        '''
+        digest = int.from_bytes(hashlib.blake2b(key, digest_size=16).digest(), 'little')
+        return np.random.SeedSequence(
+            parent.entropy, spawn_key=tuple(parent.spawn_key) + (cls.CASCADE_STREAM, digest))
+
+    def get(self, key):
+        '''
+        Returns the outage vector (uint8 array of 0 and 1, one per consumer area) of the failure set, or None if it is not cached.
+        '''
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return np.frombuffer(value, dtype=np.uint8)
+
+    def put(self, key, areas_damage):
+        '''
+        Stores the outage vector of the failure set and evicts the least recently used entries above the bounds.
+        '''
+        if key in self._entries:
+            return
+        value = np.asarray(areas_damage, dtype=np.uint8).tobytes()
+        self._entries[key] = value
+        self.size += self._entry_size(key, value)
+        while len(self._entries) > 0 and self._exceeds_bounds():
+            old_key, old_value = self._entries.popitem(last=False)
+            self.size -= self._entry_size(old_key, old_value)
+
+    def stats(self):
+        '''
+        Returns the number of hits, misses and entries, and the estimated memory (bytes) of the entries,
+        including the entries of the caches of the worker processes (see add_stats).
+        '''
+        entries = len(self._entries) + sum(entries for entries, size in self._worker_sizes.values())
+        size = self.size + sum(size for entries, size in self._worker_sizes.values())
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': size}
+
+    def add_stats(self, stats, worker=None):
+        '''
+        Adds the hits and misses of another cache (of a worker process) to the ones of this cache.
+        With a worker id, the entries and bytes of stats are the current size of the cache of that worker.
+        '''
+        self.hits += stats['hits']
+        self.misses += stats['misses']
+        if worker is not None:
+            self._worker_sizes[worker] = (stats['entries'], stats['bytes'])
+
+    def _entry_size(self, key, value):
+        return len(key) + len(value) + self.ENTRY_OVERHEAD
+
+    def _exceeds_bounds(self):
+        return ((self.max_entries is not None and len(self._entries) > self.max_entries)
+                or (self.max_bytes is not None and self.size > self.max_bytes))
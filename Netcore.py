@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Python module for the array representation of the network used in the Monte Carlo Simulation.
+Contains the Network class:
+    - Construction: from the columns of the exposure files (Netexposure)
+    - Topology: nodes and edges are identified by integer ids. The adjacency is stored in compressed sparse row (CSR) form,
+    i.e. the neighbours of node n are indices[indptr[n]:indptr[n+1]] and the connecting edges adj_edges[indptr[n]:indptr[n+1]]
+    - State: probability of failure (of nodes and lines), damage, damage increment, weight, load and capacity of nodes and edges are stored in numpy arrays
+    - State copies: the state of the unperturbed network is copied once and restored in place before each sample,
+    instead of deep-copying the whole graph (including the geometries) in every iteration
+    - Save and load: the compiled network (topology, weights, initial loads and capacities) is stored in a .npz file,
+    so that it is not rebuilt in every run
+    - Bridges: edges whose removal disconnects the network, for finding the parts that cannot affect the consumers
+
+@author: hfrv2
+"""
+
+import json
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+
+import Constants as cons
+
+
+class Network():
+    '''
+    Array-backed network with integer node and edge ids.
+    '''
+
+    # arrays that are modified during the simulation of one sample
+    STATE_ARRAYS = (
+        'node_dam', 'node_ddam', 'node_load', 'node_cap',
+        'edge_dam', 'edge_ddam', 'edge_load', 'edge_cap', 'edge_weight')
+
+    # arrays stored by save, besides the names and taxonomies of the nodes
+    # (the probabilities of failure of the nodes depend on the hazard and are not stored,
+    # the ones of the lines come from the line exposure and are stored)
+    SAVED_ARRAYS = (
+        'edge_from', 'edge_to', 'edge_weight',
+        'node_load', 'node_cap', 'edge_load', 'edge_cap', 'edge_pof')
+    # version of the file format of save (and of the weights of the lines, see Sysrel.line_weights); files of other versions are not loaded
+    FILE_VERSION = 3
+
+    def __init__(self, node_names, node_taxonomy, edge_from, edge_to):
+        self.node_names = list(node_names)
+        self.node_index = {name: i for i, name in enumerate(self.node_names)}
+        self.node_taxonomy = list(node_taxonomy)
+        self.edge_from = np.asarray(edge_from, dtype=np.intp)
+        self.edge_to = np.asarray(edge_to, dtype=np.intp)
+
+        n_nodes = len(self.node_names)
+        n_edges = len(self.edge_from)
+        self.n_nodes = n_nodes
+        self.n_edges = n_edges
+
+        # CSR adjacency (both directions of each undirected edge), sorted by node and neighbour
+        heads = np.concatenate((self.edge_from, self.edge_to))
+        tails = np.concatenate((self.edge_to, self.edge_from))
+        edge_ids = np.concatenate((np.arange(n_edges), np.arange(n_edges)))
+        order = np.lexsort((tails, heads))
+        self.indices = tails[order]
+        self.adj_edges = edge_ids[order]
+        self.indptr = np.zeros(n_nodes + 1, dtype=np.intp)
+        np.cumsum(np.bincount(heads, minlength=n_nodes), out=self.indptr[1:])
+        # sorted search keys node*n_nodes+neighbour of the CSR entries, for edge id lookups
+        self._adj_keys = heads[order] * n_nodes + self.indices
+
+        self.consumer_mask = np.array(
+            [str(tax).upper() == cons.CONSUMER.upper() for tax in self.node_taxonomy], dtype=bool)
+
+        # node arrays
+        self.node_pof = np.zeros(n_nodes)
+        self.node_dam = np.zeros(n_nodes)
+        self.node_ddam = np.zeros(n_nodes)
+        self.node_load = np.ones(n_nodes)
+        self.node_cap = np.ones(n_nodes)
+        # edge arrays
+        self.edge_pof = np.zeros(n_edges)
+        self.edge_weight = np.ones(n_edges)
+        self.edge_dam = np.zeros(n_edges)
+        self.edge_ddam = np.zeros(n_edges)
+        self.edge_load = np.ones(n_edges)
+        self.edge_cap = np.ones(n_edges)
+        # source and consumer nodes of the loads (see Netsim.od_nodes), the same for the initial loads and the cascading effects
+        self.od_sampling = cons.OD_RANDOM
+        # rank of each node in the fixed random order of the OD_FIXED sampling
+        self.od_rank = np.random.default_rng(cons.OD_FIXED_SEED).permutation(n_nodes)
+
+    @classmethod
+    def from_exposure(cls, nodes, lines, edge_weight):
+        '''
+        Creates the network of the columns (Netexposure.ExposureColumns) of the node exposure (with the probabilities
+        of failure as values) and of the line exposure, with the given weight of each line.
+        Ids, duplicates and properties are the ones of the NetworkX graph that Sysrel.load_network_data used to build:
+        the nodes are the end nodes of the lines, in the order in which they appear, the edges are the distinct pairs
+        of end nodes, ordered by their first node and then by their first line, and the properties of an edge are the
+        ones of the last line of the direction (from, to) that appears last. A node without properties (or a node
+        name that appears more than once) takes the ones of the last node of the name.
+        '''
+        n_nodes = len(lines.endpoint_names)
+        heads = np.asarray(lines.from_ids, dtype=np.intp)
+        tails = np.asarray(lines.to_ids, dtype=np.intp)
+        low = np.minimum(heads, tails)
+        high = np.maximum(heads, tails)
+        # first line of each edge, in the order of the edges
+        _, first = np.unique(low * n_nodes + high, return_index=True)
+        first = first[np.lexsort((first, low[first]))]
+        # line with the properties of each edge: the last line of each direction, of the direction that appears last
+        directions, first_line = np.unique(heads * n_nodes + tails, return_index=True)
+        _, last_reversed = np.unique((heads * n_nodes + tails)[::-1], return_index=True)
+        last_line = len(heads) - 1 - last_reversed
+        pair_keys = (np.minimum(directions // n_nodes, directions % n_nodes) * n_nodes
+                     + np.maximum(directions // n_nodes, directions % n_nodes))
+        order = np.lexsort((first_line, pair_keys))
+        is_last = np.append(pair_keys[order][1:] != pair_keys[order][:-1], True)
+        edge_lines = last_line[order][is_last][
+            np.searchsorted(pair_keys[order][is_last], low[first] * n_nodes + high[first])]
+
+        node_ids = cls._node_ids(nodes, lines.endpoint_names)
+        taxonomy = nodes.taxonomy()
+        net = cls(
+            lines.endpoint_names,
+            [taxonomy[i] if i >= 0 else '' for i in node_ids],
+            low[first], high[first])
+        net.set_node_pof(nodes)
+        net.edge_weight[:] = np.asarray(edge_weight)[edge_lines]
+        if cons.LINE_POF in lines.values:
+            edge_pof = lines.values[cons.LINE_POF][edge_lines]
+            net.edge_pof[:] = np.where(np.isnan(edge_pof), 0.0, edge_pof)
+        return net
+
+    @staticmethod
+    def _node_ids(nodes, names):
+        # index of the last node of each name in the node columns, -1 for names without node
+        node_index = {name: i for i, name in enumerate(nodes.names)}
+        return [node_index.get(name, -1) for name in names]
+
+    def set_node_pof(self, nodes):
+        '''
+        Sets the probabilities of failure of the nodes from the columns of the node exposure
+        (Netexposure.ExposureColumns, with the probabilities of failure as values), by node name.
+        Nodes without probability of failure (missing node or null value) get 0.
+        '''
+        node_pof = np.append(nodes.values[cons.NODE_POF], 0.0)[self._node_ids(nodes, self.node_names)]
+        self.node_pof[:] = np.where(np.isnan(node_pof), 0.0, node_pof)
+
+    def save(self, file, **extra_arrays):
+        '''
+        Saves the topology, the weights, the loads and the capacities
+        and the probabilities of failure of the lines (not the damage state nor the
+        probabilities of failure of the nodes) in .npz format,
+        together with the given extra arrays. The file can be a name or a file object.
+        '''
+        arrays = {name: getattr(self, name) for name in self.SAVED_ARRAYS}
+        # the names are kept as json, so that their types are preserved
+        arrays['node_names'] = np.array(json.dumps(self.node_names))
+        arrays['node_taxonomy'] = np.array(json.dumps(self.node_taxonomy))
+        arrays['file_version'] = np.array(self.FILE_VERSION)
+        for name, values in extra_arrays.items():
+            arrays['extra_' + name] = np.asarray(values)
+        np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, file):
+        '''
+        Loads a network saved by save. Returns the network and a dict with the extra arrays.
+        Raises a ValueError for files of another version.
+        '''
+        with np.load(file, allow_pickle=False) as data:
+            if 'file_version' not in data.files or int(data['file_version']) != cls.FILE_VERSION:
+                raise ValueError('Not supported network file version')
+            net = cls(
+                json.loads(str(data['node_names'])),
+                json.loads(str(data['node_taxonomy'])),
+                data['edge_from'],
+                data['edge_to'])
+            for name in cls.SAVED_ARRAYS[2:]:
+                getattr(net, name)[:] = data[name]
+            extra_arrays = {
+                name[len('extra_'):]: data[name] for name in data.files if name.startswith('extra_')}
+        return net, extra_arrays
+
+    def edge_names(self):
+        '''
+        Returns the edges as pairs of node names, in the order of the edge ids.
+        '''
+        return [
+            [self.node_names[u], self.node_names[v]]
+            for u, v in zip(self.edge_from, self.edge_to)]
+
+    def incident_edges(self, node):
+        '''
+        Returns the ids of the edges adjacent to the given node.
+        '''
+        return self.adj_edges[self.indptr[node]:self.indptr[node + 1]]
+
+    def edge_ids(self, u, v):
+        '''
+        Returns the ids of the edges between the nodes u and v
+        (scalars or arrays of the same length).
+        '''
+        keys = np.asarray(u) * self.n_nodes + np.asarray(v)
+        return self.adj_edges[np.searchsorted(self._adj_keys, keys)]
+
+    def degree(self):
+        '''
+        Returns the number of adjacent edges of every node.
+        '''
+        return np.diff(self.indptr)
+
+    def weighted_adjacency(self, cutoff=None):
+        '''
+        Returns the (symmetric) adjacency matrix with the current edge weights,
+        as needed by the scipy.sparse.csgraph routines.
+        If a cutoff is given, weights larger or equal than the cutoff (removed edges) are replaced
+        by a value larger than the total length of the remaining edges. Shortest paths then
+        minimise first the number of removed edges and then the length of the other edges.
+        This is an intentional change of the model: the former NetworkX implementation only
+        minimised the number of removed edges, since 1/EPS absorbs any finite length in floating
+        point, and chose arbitrarily among the paths with the same number of them.
+        '''
+        weights = self.edge_weight[self.adj_edges]
+        if cutoff is not None:
+            removed = weights >= cutoff
+            weights[removed] = 2.0 * (np.sum(weights[~removed]) + 1.0)
+        return scipy.sparse.csr_matrix(
+            (weights, self.indices, self.indptr),
+            shape=(self.n_nodes, self.n_nodes))
+
+    def component_labels(self, edge_mask):
+        '''
+        Labels the connected components of the network formed by the edges selected
+        by the boolean mask. Returns one label per node.
+        '''
+        from_nodes = self.edge_from[edge_mask]
+        to_nodes = self.edge_to[edge_mask]
+        adjacency = scipy.sparse.csr_matrix(
+            (np.ones(len(from_nodes)), (from_nodes, to_nodes)),
+            shape=(self.n_nodes, self.n_nodes))
+        _, labels = scipy.sparse.csgraph.connected_components(adjacency, directed=False)
+        return labels
+
+    def bridges(self):
+        '''
+        Returns a boolean mask of the bridges, the edges whose removal disconnects their end nodes
+        (iterative depth-first search with the lowest discovery order reachable from each subtree).
+        '''
+        indptr = self.indptr.tolist()
+        indices = self.indices.tolist()
+        adj_edges = self.adj_edges.tolist()
+        order = [-1] * self.n_nodes
+        low = [0] * self.n_nodes
+        is_bridge = np.zeros(self.n_edges, dtype=bool)
+        counter = 0
+        for root in range(self.n_nodes):
+            if order[root] >= 0:
+                continue
+            order[root] = low[root] = counter
+            counter += 1
+            # (node, edge from its parent, position of the next neighbour)
+            stack = [(root, -1, indptr[root])]
+            while stack:
+                node, parent_edge, pos = stack[-1]
+                if pos < indptr[node + 1]:
+                    stack[-1] = (node, parent_edge, pos + 1)
+                    edge = adj_edges[pos]
+                    if edge == parent_edge:
+                        continue
+                    neighbour = indices[pos]
+                    if order[neighbour] < 0:
+                        order[neighbour] = low[neighbour] = counter
+                        counter += 1
+                        stack.append((neighbour, edge, indptr[neighbour]))
+                    else:
+                        low[node] = min(low[node], order[neighbour])
+                else:
+                    stack.pop()
+                    if stack:
+                        parent = stack[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                        if low[node] > order[parent]:
+                            is_bridge[parent_edge] = True
+        return is_bridge
+
+    def copy_state(self):
+        '''
+        Returns a copy of the arrays that are modified during a sample.
+        '''
+        return {name: getattr(self, name).copy() for name in self.STATE_ARRAYS}
+
+    def restore_state(self, state):
+        '''
+        Resets the arrays in place to a state previously returned by copy_state.
+        '''
+        for name in self.STATE_ARRAYS:
+            np.copyto(getattr(self, name), state[name])
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Python module for the columnar representation of the exposure data (GeoJSON feature collections of nodes and lines).
+Contains the load_json function and the ExposureColumns class:
+    - Byte order marks: the UTF-8 byte order mark, and its Windows-1252 rendering re-encoded in UTF-8 (the character
+    sequence that used to be replaced in the text), are removed from the bytes of the file before it is parsed
+    - Columns: a single pass over the features gives the names, the taxonomy codes (indices of the distinct taxonomies),
+    the end nodes of the lines (indices of the node names, in the order in which they appear), the numeric properties
+    (float arrays, NaN for missing values) and the coordinates (all the points of the geometries, with one row of offsets per feature)
+    - Sidecar: the columns are stored in a binary file next to the network cache, and loaded from it memory-mapped
+    as long as the hash of the GeoJSON file is the same
+
+@author: hfrv2
+"""
+
+import codecs
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import Constants as cons
+
+# byte order mark, and its Windows-1252 characters in UTF-8 (which appear when a file with a byte order mark is converted again)
+UTF8_BOM = codecs.BOM_UTF8
+CONVERTED_BOM = codecs.BOM_UTF8.decode('cp1252').encode('utf8')
+
+
+def load_json(data):
+    '''
+    Parses the bytes of a UTF-8 json file, without byte order marks.
+    '''
+    if data.startswith(UTF8_BOM):
+        data = data[len(UTF8_BOM):]
+    if CONVERTED_BOM in data:
+        data = data.replace(CONVERTED_BOM, b'')
+    return json.loads(data.decode('utf8'))
+
+
+class ExposureColumns():
+    '''
+    Columns of the properties and geometries of the features of an exposure file.
+    '''
+
+    # first bytes of the sidecar files, and version of their format; files of other versions are rebuilt
+    MAGIC = b'EXPCOLS\n'
+    FILE_VERSION = 1
+    # alignment (bytes) of the arrays in the sidecar files
+    ALIGNMENT = 64
+    # arrays stored in the sidecar files (the values are stored as value_0, value_1, ... in the order of value_keys)
+    ARRAYS = ('taxonomy_codes', 'from_ids', 'to_ids', 'coordinates', 'coordinate_indptr')
+
+    def __init__(self, names, taxonomies, taxonomy_codes, endpoint_names, from_ids, to_ids, values,
+                 coordinates, coordinate_indptr):
+        self.names = names
+        self.taxonomies = taxonomies
+        self.taxonomy_codes = taxonomy_codes
+        # names of the end nodes of the lines (empty for nodes), from_ids and to_ids are indices of them
+        self.endpoint_names = endpoint_names
+        self.from_ids = from_ids
+        self.to_ids = to_ids
+        # float array of each numeric property, by property name
+        self.values = values
+        # points (x, y) of the geometries; the ones of feature i are coordinates[coordinate_indptr[i]:coordinate_indptr[i+1]]
+        self.coordinates = coordinates
+        self.coordinate_indptr = coordinate_indptr
+
+    def __len__(self):
+        return len(self.taxonomy_codes)
+
+    @classmethod
+    def from_features(cls, features, name_key=None, value_keys=(), lines=False):
+        '''
+        Creates the columns of a list of GeoJSON features: the names (property name_key, None without it),
+        the taxonomies, the numeric properties value_keys and, if lines, the end nodes (properties FROM and TO).
+        '''
+        names = []
+        taxonomies = []
+        taxonomy_index = {}
+        taxonomy_codes = []
+        endpoint_names = []
+        endpoint_index = {}
+        from_ids = []
+        to_ids = []
+        values = [[] for key in value_keys]
+        coordinates = []
+        coordinate_indptr = [0]
+        for feature in features:
+            properties = feature[cons.PROPERTIES]
+            names.append(properties.get(name_key) if name_key is not None else None)
+            taxonomy = properties.get(cons.TAXONOMY, '')
+            if taxonomy not in taxonomy_index:
+                taxonomy_index[taxonomy] = len(taxonomies)
+                taxonomies.append(taxonomy)
+            taxonomy_codes.append(taxonomy_index[taxonomy])
+            if lines:
+                for name, ids in ((properties[cons.FROM], from_ids), (properties[cons.TO], to_ids)):
+                    if name not in endpoint_index:
+                        endpoint_index[name] = len(endpoint_names)
+                        endpoint_names.append(name)
+                    ids.append(endpoint_index[name])
+            for key, column in zip(value_keys, values):
+                column.append(cls._to_float(properties.get(key)))
+            geometry = feature.get(cons.GEOMETRY)
+            if geometry is not None:
+                cls._add_points(geometry.get(cons.COORDINATES), coordinates)
+            coordinate_indptr.append(len(coordinates))
+        return cls(
+            names, taxonomies, np.array(taxonomy_codes, dtype=np.intp), endpoint_names,
+            np.array(from_ids, dtype=np.intp), np.array(to_ids, dtype=np.intp),
+            {key: np.array(column, dtype=float) for key, column in zip(value_keys, values)},
+            np.array(coordinates, dtype=float).reshape(-1, 2), np.array(coordinate_indptr, dtype=np.intp))
+
+    @staticmethod
+    def _to_float(value):
+        # missing or empty values (e.g. null in the geojson file) are NaN
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return np.nan
+
+    @staticmethod
+    def _add_points(coordinates, points):
+        # appends the (x, y) points of the nested coordinates of a geometry (points, lines or multi-lines)
+        if not coordinates:
+            return
+        if not isinstance(coordinates[0], list):
+            points.append(coordinates[:2])
+            return
+        for part in coordinates:
+            ExposureColumns._add_points(part, points)
+
+    @classmethod
+    def read(cls, filename, name_key=None, value_keys=(), lines=False, sidecar=None):
+        '''
+        Reads the columns of a GeoJSON file (see from_features). With a sidecar file, they are loaded from it if it was
+        written for the same contents of the file and the same arguments, otherwise it is (re)written.
+        '''
+        with open(filename, 'rb') as f:
+            data = f.read()
+        source = {
+            'hash': hashlib.sha256(data).hexdigest(), 'name_key': name_key,
+            'value_keys': list(value_keys), 'lines': lines}
+        if sidecar is not None and os.path.exists(sidecar):
+            try:
+                columns, sidecar_source = cls.load(sidecar)
+                if sidecar_source == source:
+                    return columns
+            except (OSError, ValueError, KeyError):
+                pass# written by another version, rebuilt
+        columns = cls.from_features(load_json(data)[cons.FEATURES], name_key, value_keys, lines)
+        if sidecar is not None:
+            columns.save(sidecar, source)
+        return columns
+
+    def save(self, filename, source=None):
+        '''
+        Saves the columns in a binary file: a json header (with the names, the taxonomies and the offsets of the arrays,
+        and the given source description) followed by the arrays. The file is written under a temporary name first,
+        so that concurrent runs never read a partial file.
+        '''
+        arrays = [(name, getattr(self, name)) for name in self.ARRAYS]
+        arrays += [('value_' + str(i), self.values[key]) for i, key in enumerate(self.values)]
+        layout = {}
+        offset = 0
+        for name, array in arrays:
+            layout[name] = [array.dtype.str, list(array.shape), offset]
+            offset += self._aligned(array.nbytes)
+        header = json.dumps({
+            'file_version': self.FILE_VERSION, 'source': source, 'names': self.names, 'taxonomies': self.taxonomies,
+            'endpoint_names': self.endpoint_names, 'value_keys': list(self.values), 'arrays': layout}).encode('utf8')
+        start = self._aligned(len(self.MAGIC) + 8 + len(header))
+        folder = os.path.dirname(filename)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        tmp_filename = filename + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(self.MAGIC)
+            f.write(np.uint64(len(header)).tobytes())
+            f.write(header)
+            for name, array in arrays:
+                f.seek(start + layout[name][2])
+                f.write(np.ascontiguousarray(array).tobytes())
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Loads columns saved by save, with the arrays memory-mapped (read-only).
+        Returns the columns and the source description. Raises a ValueError for files of another version.
+        '''
+        with open(filename, 'rb') as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError('Not an exposure columns file')
+            header_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_size).decode('utf8'))
+        if header['file_version'] != cls.FILE_VERSION:
+            raise ValueError('Not supported exposure columns file version')
+        start = cls._aligned(len(cls.MAGIC) + 8 + header_size)
+        arrays = {}
+        for name, (dtype, shape, offset) in header['arrays'].items():
+            if np.prod(shape) == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)# empty files cannot be mapped
+            else:
+                arrays[name] = np.memmap(filename, dtype=dtype, mode='r', offset=start + offset, shape=tuple(shape))
+        values = {key: arrays['value_' + str(i)] for i, key in enumerate(header['value_keys'])}
+        columns = cls(
+            header['names'], header['taxonomies'], arrays['taxonomy_codes'], header['endpoint_names'],
+            arrays['from_ids'], arrays['to_ids'], values, arrays['coordinates'], arrays['coordinate_indptr'])
+        return columns, header['source']
+
+    @classmethod
+    def _aligned(cls, size):
+        return -(-size // cls.ALIGNMENT) * cls.ALIGNMENT
+
+    def taxonomy(self):
+        '''
+        Returns the taxonomy of every feature.
+        '''
+        return [self.taxonomies[code] for code in self.taxonomy_codes]
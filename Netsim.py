@@ -2,14 +2,17 @@
 """
 Python module for network simulation. Contains the main steps of the Monte Carlo Simulation:
     - Direct Hazard Action: applies a random damage state to the system, given probabilities of failures assigned to the nodes by the damage web service
+    (and optionally to the lines). The failures of a block of samples are sampled at once, as boolean matrices (samples x components).
+    With importance sampling, the failures are sampled with biased probabilities and each sample gets its likelihood ratio
     - Cascading Effects: simulates systemic failures due to overloading. Affects nodes and lines
     - State of consumer areas: estimates the affectation to the consumer areas, based on the damage level of the supplier lines
+    (mean damage of the supply lines of all the areas at once, with a sparse incidence matrix of the areas and lines built once per network)
     - other functions:
         - Network update: removes failed/isolated source and consumer nodes, and updates surviving component capacities, 
         for recomputing the loads during the simulation of cascading effects
-        - Node and edge ODBC: Computes the Origin-Destination Betweenness Centrality (ODBC) to nodes and edges
-        - Load evaluation: assigns loads to the nodes and edges based on the ODBC
-        - Is edge in path?: returns true or false, depending whether an edge is in a given path.
+        - Node and edge ODBC: Computes the Origin-Destination Betweenness Centrality (ODBC) to nodes and edges, with one shortest path tree per source node
+        - Load evaluation: assigns loads to the nodes and edges based on the ODBC, from random, all or a fixed subsample of the source and consumer nodes
+All functions operate on the array representation of the network (Netcore.Network), whose state arrays are modified in place.
         
 
 Created on Wed Aug 14 14:49:53 2019
@@ -18,196 +21,208 @@ Created on Wed Aug 14 14:49:53 2019
 """
 
 import numpy as np
-import networkx as nx
+import scipy.sparse
+import scipy.sparse.csgraph
 import Constants as cons
-import random
 
-def direct_hazard_action(G): 
-        # Evaluate Component Fragilities
-        for node in G.nodes():
-            n_pof=G.nodes[node][cons.NODE_POF]
-            # if component is certainly damaged
-            if n_pof>1-cons.EPS:
-                G.nodes[node][cons.NODE_DAMAGE]=1
-            # if component is certainly working
-            elif n_pof<cons.EPS:
-                G.nodes[node][cons.NODE_DAMAGE]=0
-            else:
-                #generate random value between 0 and 1
-                r_value=np.random.rand()
-                #query probability of failure
-                if r_value<n_pof:
-                    G.nodes[node][cons.NODE_DAMAGE]=1
+'''DIRECT HAZARD ACTION
+applies one row of the failure matrices (see sample_failures): the failed nodes (and lines) get damage 1'''
+def direct_hazard_action(net,node_failures,edge_failures=None): 
+        net.node_dam[node_failures]=1
+        if edge_failures is not None:
+            net.edge_dam[edge_failures]=1
+
+'''SAMPLE FAILURES
+failure matrix (samples x components) of a block of samples in one array operation, given the probabilities of failure
+and one row of uniform random numbers per sample:
+a component fails if it is certainly damaged (pof>1-EPS), or if it is not certainly working (pof>=EPS) and its number is below its pof'''
+def sample_failures(pof,uniforms):
+    return (pof>1-cons.EPS)|((pof>=cons.EPS)&(uniforms<pof))
+
+'''DRAW UNIFORMS
+uniform random numbers of a block of samples, one row per sample from its own random stream (numpy Generator).
+Only the uncertain components draw a number (in the order of their ids), the other entries are 1 (they do not matter)'''
+def draw_uniforms(pof,rngs):
+    uncertain=np.flatnonzero((pof<=1-cons.EPS)&(pof>=cons.EPS))
+    uniforms=np.ones((len(rngs),len(pof)))
+    if len(uncertain)>0:
+        for row,rng in enumerate(rngs):
+            uniforms[row,uncertain]=rng.random(len(uncertain))
+    return uniforms
+
+'''LIKELIHOOD RATIOS
+weight of each row of a failure matrix sampled with the probabilities of failure sampling_pof (importance sampling),
+for estimating expectations under the probabilities of failure pof: product over the components of p/q if failed, (1-p)/(1-q) otherwise.
+The products are summed as logarithms; only the components with q!=p contribute'''
+def likelihood_ratios(pof,sampling_pof,failures):
+    biased=np.flatnonzero(sampling_pof!=pof)
+    p=pof[biased]
+    q=sampling_pof[biased]
+    log_ratio=np.where(failures[:,biased],np.log(p)-np.log(q),np.log1p(-p)-np.log1p(-q))
+    return np.exp(np.sum(log_ratio,axis=1))
 
 '''UPDATE SOURCE AND TERMINAL NODES; AND EDGE WEIGHTS
 The damage increment DELTADAMAGE is reset to zero after updating the damage of the components'''
-def update_network(G,s_nodes,t_nodes):
+def update_network(net,s_nodes,t_nodes):
     # first, reduce node capacities
-    for node in G.nodes():
-        
-
-        # if damage is larger than the critical damage (e.g. by hazard action), set capacity to zero
-        if G.nodes[node][cons.NODE_DAMAGE]>cons.CRIT_DAMAGE:
-            # remove this node from source and terminal nodes list
-            if node in s_nodes:
-                s_nodes.remove(node)
-            if node in t_nodes:
-                t_nodes.remove(node)
-            G.nodes[node][cons.CAPACITY]=0.0
-            G.nodes[node][cons.NODE_DAMAGE]=1
-            # and isolate the node
-            for edge in G.edges(node):
-               G.edges[edge][cons.WEIGHT]=1/cons.EPS 
-               G.edges[edge][cons.CAPACITY]=0
-               G.edges[edge][cons.LINE_DAMAGE]=1
-               
-        #otherwise, only reduce capacity
-        else:
-            G.nodes[node][cons.CAPACITY]-=G.nodes[node][cons.NODE_DELTADAMAGE]*G.nodes[node][cons.CAPACITY]
-            #we already added the damage increment to the total damage, hence reset the increment to zero 
-            G.nodes[node][cons.NODE_DELTADAMAGE]=0.0
+    # if damage is larger than the critical damage (e.g. by hazard action), set capacity to zero
+    failed=net.node_dam>cons.CRIT_DAMAGE
+    # remove these nodes from source and terminal nodes list
+    s_nodes[:]=[node for node in s_nodes if not failed[node]]
+    t_nodes[:]=[node for node in t_nodes if not failed[node]]
+    net.node_cap[failed]=0.0
+    net.node_dam[failed]=1
+    # and isolate the nodes
+    isolate_edges(net,failed[net.edge_from]|failed[net.edge_to])
+    #otherwise, only reduce capacity
+    working=~failed
+    net.node_cap[working]-=net.node_ddam[working]*net.node_cap[working]
+    #we already added the damage increment to the total damage, hence reset the increment to zero 
+    net.node_ddam[working]=0.0
     
     # now check whether any consumer node is disconnected from the network, and reduce capacity of edges adjacent to damaged nodes
-    for node in G.nodes():       
-        # not connected consumers to sources makes them unavailable too
-        if G.nodes[node][cons.TAXONOMY].upper()==cons.CONSUMER.upper():
-            stillpath=False
-            for snod in s_nodes:
-                spl=nx.shortest_path_length(G,snod,node,weight=cons.WEIGHT)
-                #print('from '+snod+' to '+node+': '+str(spl))
-                # if there is still a path with "reasonably" finite length, we are done. We take "infinity" as 0.5/EPS
-                if spl<0.5/cons.EPS:
-                    stillpath=True
-                    break
-            # if no shortest path exists from any source node, that consumer is isolated
-            if not stillpath:
-                G.nodes[node][cons.NODE_DAMAGE]=1#here damage 1 means "disconnected"
-                #all adjacent distribution lines have no power. We represent this with damage 1 as well
-                for edge in G.edges(node):
-                   G.edges[edge][cons.WEIGHT]=1/cons.EPS 
-                   G.edges[edge][cons.CAPACITY]=0
-                   G.edges[edge][cons.LINE_DAMAGE]=1
-
-            
-            
+    # not connected consumers to sources makes them unavailable too
+    # there is still a path with "reasonably" finite length if it only uses edges with weight below 0.5/EPS ("infinity"),
+    # i.e. if the consumer is in the same connected component of these edges as a surviving source node
+    labels=net.component_labels(net.edge_weight<0.5/cons.EPS)
+    stillpath=np.isin(labels,labels[s_nodes])
+    # if no path exists from any source node, that consumer is isolated
+    isolated=net.consumer_mask&~stillpath
+    net.node_dam[isolated]=1#here damage 1 means "disconnected"
+    #all adjacent distribution lines have no power. We represent this with damage 1 as well
+    isolate_edges(net,isolated[net.edge_from]|isolated[net.edge_to])
           
     # now, increase edge cost and reduce their capacities
-    for edge in G.edges():
-        # if damage is larger than the critical damage, set capacity to zero and weight arbitrarily large
-        if G.edges[edge][cons.LINE_DAMAGE]>cons.CRIT_DAMAGE:
-            G.edges[edge][cons.CAPACITY]=0.0
-            G.edges[edge][cons.WEIGHT]=1/cons.EPS
-        else:
-            G.edges[edge][cons.CAPACITY]-=G.edges[edge][cons.LINE_DELTADAMAGE]*G.edges[edge][cons.CAPACITY]
-            G.edges[edge][cons.WEIGHT]/=max(1-G.edges[edge][cons.LINE_DELTADAMAGE],cons.EPS)
-        #we already applied the damage increment
-        G.edges[edge][cons.LINE_DELTADAMAGE]=0.0
+    # if damage is larger than the critical damage, set capacity to zero and weight arbitrarily large
+    crit=net.edge_dam>cons.CRIT_DAMAGE
+    net.edge_cap[crit]=0.0
+    net.edge_weight[crit]=1/cons.EPS
+    ok=~crit
+    net.edge_cap[ok]-=net.edge_ddam[ok]*net.edge_cap[ok]
+    net.edge_weight[ok]/=np.maximum(1-net.edge_ddam[ok],cons.EPS)
+    #we already applied the damage increment
+    net.edge_ddam[:]=0.0
+
+'''Disconnects the edges selected by the boolean mask: arbitrarily large weight, no capacity and damage 1'''
+def isolate_edges(net,edge_mask):
+    net.edge_weight[edge_mask]=1/cons.EPS 
+    net.edge_cap[edge_mask]=0
+    net.edge_dam[edge_mask]=1
 
 ''' Determines shortest paths between all source and target nodes, and assigns them
 to the nodes and edges as loads through the Origin-Destination betweenness cetrality'''
-def evaluate_system_loads(G,s_nodes,t_nodes):
-    loads_initial={}
-    edge_loads_initial={}
-    param_k=min(30,len(G.nodes()))
-    loads_initial=OD_node_betweenness_centrality(G,s_nodes,t_nodes,weight=cons.WEIGHT,normalized=False,k=param_k)
-    #edge_loads_initial=nx.edge_betweenness_centrality(G,weight=cons.WEIGHT,normalized=False,k=param_k)
-    edge_loads_initial=OD_edge_betweenness_centrality(G,s_nodes,t_nodes,weight=cons.WEIGHT,normalized=False,k=param_k)
-    node_attribs={no:{cons.LOAD:loads_initial[no]} for no in G.nodes()}
-    edge_attribs={ed:{cons.LOAD:edge_loads_initial[ed]} for ed in G.edges()}
-    nx.set_node_attributes(G,node_attribs)
-    nx.set_edge_attributes(G,edge_attribs)
+def evaluate_system_loads(net,s_nodes,t_nodes,seed=None):
+    s_nodes,t_nodes,param_k=od_nodes(net,s_nodes,t_nodes)
+    net.node_load[:],net.edge_load[:]=OD_betweenness_centrality(net,s_nodes,t_nodes,normalized=False,k=param_k,seed=seed)
+
+'''True if the loads of evaluate_system_loads do not depend on the random stream: all the source and terminal nodes or a fixed subsample of them are used'''
+def loads_are_exact(net,s_nodes,t_nodes):
+    s_nodes,t_nodes,param_k=od_nodes(net,s_nodes,t_nodes)
+    return param_k is None or (len(s_nodes)<=param_k and len(t_nodes)<=param_k)
+
+'''OD SAMPLING
+source and terminal nodes of the loads, and number k of them that OD_betweenness_centrality samples at random, given net.od_sampling:
+    - OD_RANDOM: all the nodes, k=OD_SAMPLES (a new random subsample in every evaluation)
+    - OD_EXACT: all the nodes, k=None
+    - OD_FIXED: the first OD_SAMPLES nodes of each list in the fixed random order of the network (net.od_rank), k=None.
+    A node keeps its place in the subsample while it survives, so the loads only change with the damage'''
+def od_nodes(net,s_nodes,t_nodes):
+    if net.od_sampling==cons.OD_EXACT:
+        return s_nodes,t_nodes,None
+    param_k=min(cons.OD_SAMPLES,net.n_nodes)
+    if net.od_sampling==cons.OD_FIXED:
+        return first_ranked(s_nodes,net.od_rank,param_k),first_ranked(t_nodes,net.od_rank,param_k),None
+    if net.od_sampling!=cons.OD_RANDOM:
+        raise ValueError('Not supported OD sampling: '+str(net.od_sampling))
+    return s_nodes,t_nodes,param_k
+
+'''the k nodes of the list with the lowest rank, sorted by id'''
+def first_ranked(nodes,rank,k):
+    nodes=np.asarray(nodes,dtype=np.intp)
+    if len(nodes)<=k:
+        return nodes
+    return np.sort(nodes[np.argsort(rank[nodes],kind='stable')[:k]])
 
 '''CASCADING EFFECTS
 Updates component state vector with failures due to nodes disconnection
-and overloading'''
-def simulate_cascading_effects(G,s_nodes,t_nodes,max_iteration):
+and overloading. The loads are evaluated from scratch in every iteration: the damage of an iteration changes a large part
+of the shortest path trees (a third of their nodes or more in the cascades of the test inputs), and repairing them is
+slower than new Dijkstra searches on networks of a few hundred nodes'''
+def simulate_cascading_effects(net,s_nodes,t_nodes,max_iteration,seed=None):
+    rng=np.random.default_rng(seed)
     iteration_casc=0
-    component_state=0
-    component_state_upd=1
+    component_state=None
     # new failures occur
-    while iteration_casc<max_iteration and component_state_upd!=component_state: 
-       
-        component_state=component_state_upd 
+    while iteration_casc<max_iteration: 
         
         # DISCONNECTION FAILURE
         # assess perturbed network
-        evaluate_system_loads(G,s_nodes,t_nodes)
-        n_loads=nx.get_node_attributes(G,cons.LOAD)
-        e_loads=nx.get_edge_attributes(G,cons.LOAD)
-        n_caps=nx.get_node_attributes(G,cons.CAPACITY)
-        e_caps=nx.get_edge_attributes(G,cons.CAPACITY)
-        for node in G.nodes():
-            #if new node load exceeds its capacity
-            if n_caps[node]>cons.EPS:
-                n_ratio=n_loads[node]/n_caps[node]
-                if n_ratio>1:
-                    #print('Casc effects nodes')
-                    #reduce capacity and store de damage increment
-                    n_state=1-G.nodes[node][cons.NODE_DAMAGE]
-                    #update the damage level
-                    G.nodes[node][cons.NODE_DAMAGE]=1-(1/n_ratio)*n_state
-                    #store the damage increment
-                    if n_state<cons.MIN_DAMAGE:
-                        G.nodes[node][cons.NODE_DELTADAMAGE]=n_state
-                    else:
-                        G.nodes[node][cons.NODE_DELTADAMAGE]=G.nodes[node][cons.NODE_DAMAGE]-(1-n_state)
-        
-        for edge in G.edges():
-            #if new node load exceeds its capacity
-            if e_caps[edge]>cons.EPS:
-                e_ratio=e_loads[edge]/e_caps[edge]
-                if e_ratio>1:
-                    #print('Casc effects edges')
-                    #reduce capacity and store de damage increment
-                    e_state=1-G.edges[edge][cons.LINE_DAMAGE]
-                    #update the damage level
-                    G.edges[edge][cons.LINE_DAMAGE]=1-(1/e_ratio)*e_state
-                    #store the damage increment
-                    if e_state<cons.EPS:
-                        G.edges[edge][cons.LINE_DELTADAMAGE]=e_state
-                    else:
-                        G.edges[edge][cons.LINE_DELTADAMAGE]=G.edges[edge][cons.LINE_DAMAGE]-(1-e_state)
-        update_network(G,s_nodes,t_nodes)
-        component_state_upd={cons.NODES:nx.get_node_attributes(G,cons.NODE_DAMAGE),cons.EDGES:nx.get_edge_attributes(G,cons.LINE_DAMAGE)}
+        evaluate_system_loads(net,s_nodes,t_nodes,seed=rng)
+        #if new node load exceeds its capacity
+        overload_components(net.node_load,net.node_cap,net.node_dam,net.node_ddam,cons.MIN_DAMAGE)
+        #if new edge load exceeds its capacity
+        overload_components(net.edge_load,net.edge_cap,net.edge_dam,net.edge_ddam,cons.EPS)
+        update_network(net,s_nodes,t_nodes)
+        component_state_upd=np.concatenate((net.node_dam,net.edge_dam))
         iteration_casc+=1
-    #return component_state_upd
+        # stop when the damage state does not change anymore
+        if component_state is not None and np.array_equal(component_state_upd,component_state):
+            break
+        component_state=component_state_upd
+
+'''Increases the damage of overloaded components (load larger than capacity) and stores the damage increment.
+Components whose undamaged fraction is below the threshold transfer all of it to the increment'''
+def overload_components(loads,caps,dam,ddam,threshold):
+    over=np.flatnonzero(caps>cons.EPS)
+    ratio=loads[over]/caps[over]
+    over,ratio=over[ratio>1],ratio[ratio>1]
+    #reduce capacity and store de damage increment
+    state=1-dam[over]
+    #update the damage level
+    dam[over]=1-(1/ratio)*state
+    #store the damage increment
+    ddam[over]=np.where(state<threshold,state,dam[over]-(1-state))
         
 '''estimate affectation to consumer areas'''
 
-def set_state_consumers(ExposureConsumerAreas,Graph):
-    areas_damage=[]#store the areas states in a vector. 0 means ok, 1 means blackout
-    for i in range(0,len(ExposureConsumerAreas[cons.FEATURES])):
-        key_a_name=ExposureConsumerAreas[cons.FEATURES][i][cons.PROPERTIES][cons.AREA_NAME]
-        # if consumer node itself is not connected to source, then area has blackout
-        if Graph.nodes[key_a_name][cons.NODE_DAMAGE]>1-cons.EPS:
-            areas_damage.append(1)# 1 means has a blackout
-        # otherwise, check how "strong" are the connections
-        else:
-            # if the consumer area has a consumer node connected to the network
-            if len(Graph.edges(key_a_name))>0:
-                supply_edge_dam=[Graph.edges[edge][cons.LINE_DAMAGE] for edge in Graph.edges(key_a_name)]   
-                # if adjacent lines have on average a large damage level
-                if np.mean(supply_edge_dam)>cons.CRIT_DAMAGE:
-                    areas_damage.append(1)# 1, then the area has a blackout
-                else:
-                    areas_damage.append(0)# 0, otherwise the area has no blackout
-            # Otherwisethe area is isolated (lines removed, damaged, or they never were in model)
-            else:
-                areas_damage.append(1)
-    return areas_damage
-
-# IS AN EDGE IN A PATH?
-def is_edge_in_path(edge,path):
-    G=nx.Graph()
-    G.add_path(path)
-    if edge in G.edges():
-        return True
-    else:
-        return False
-    
-def OD_node_betweenness_centrality(G, s_nodes, c_nodes, k=None, normalized=True, weight=None,
+def set_state_consumers(ExposureConsumerAreas,net,consumers=None):
+    # index of the areas (see consumer_incidence), built here if it is not given
+    area_nodes,incidence,n_supply=consumers if consumers is not None else consumer_incidence(ExposureConsumerAreas,net)
+    # if consumer node itself is not connected to source, then area has blackout
+    blackout=net.node_dam[area_nodes]>1-cons.EPS
+    # otherwise, check how "strong" are the connections: if adjacent lines have on average a large damage level, the area has a blackout
+    mean_damage=incidence.dot(net.edge_dam)/np.maximum(n_supply,1)
+    blackout|=mean_damage>cons.CRIT_DAMAGE
+    # areas without adjacent lines are isolated (lines removed, damaged, or they never were in model)
+    blackout|=n_supply==0
+    #store the areas states in a vector. 0 means ok, 1 means blackout
+    return blackout.astype(np.uint8)
+
+'''CONSUMER AREAS INDEX
+node of each consumer area (by name), sparse incidence matrix (areas x edges) of the lines adjacent to these nodes (the supply lines)
+and number of supply lines of each area. Built once for all the samples of a network'''
+def consumer_incidence(ExposureConsumerAreas,net):
+    area_nodes=np.array([net.node_index[fea[cons.PROPERTIES][cons.AREA_NAME]] for fea in ExposureConsumerAreas[cons.FEATURES]],dtype=np.intp)
+    degree=net.degree()[area_nodes]
+    indptr=np.zeros(len(area_nodes)+1,dtype=np.intp)
+    np.cumsum(degree,out=indptr[1:])
+    # the supply lines of each area are the adjacent edges of its node in the CSR adjacency, in the same order
+    positions=np.repeat(net.indptr[area_nodes]-indptr[:-1],degree)+np.arange(indptr[-1])
+    rows=np.repeat(np.arange(len(area_nodes)),degree)
+    edges=net.adj_edges[positions]
+    # a line from the node of the area to itself is adjacent twice, but it is one supply line
+    _,first=np.unique(rows*net.n_edges+edges,return_index=True)
+    first.sort()
+    rows,edges=rows[first],edges[first]
+    n_supply=np.bincount(rows,minlength=len(area_nodes))
+    np.cumsum(n_supply,out=indptr[1:])
+    incidence=scipy.sparse.csr_matrix(
+        (np.ones(len(edges)),edges,indptr),shape=(len(area_nodes),net.n_edges))
+    return area_nodes,incidence,n_supply
+
+def OD_betweenness_centrality(net, s_nodes, c_nodes, k=None, normalized=True,
                                 seed=None):
-    """Compute betweenness centrality for edges, considering paths between source and consumer nodes.
+    r"""Compute betweenness centrality for nodes and edges, considering paths between source and consumer nodes.
     
     This function is a modified version of networkx package function edge_betweenness_centrality()
 
@@ -221,92 +236,16 @@ def OD_node_betweenness_centrality(G, s_nodes, c_nodes, k=None, normalized=True,
     where $SV$ is the set of source nodes, $CV$ is the set of consumer nodes,
     $\sigma(s, t)$ is the number of shortest $(s, t)$-paths, and $\sigma(s, t|e)$ 
     is the number of     those paths passing through edge $e$ [2]_.
+    The betweenness of a node is defined likewise (end points included).
 
-    Parameters
-    ----------
-    G : graph
-      A NetworkX graph.
-
-    k : int, optional (default=None)
-      If k is not None use k node samples to estimate betweenness.
-      The value of k <= n where n is the number of nodes in the graph.
-      Higher values give better approximation.
-    
-    s_nodes: set of source nodes
-    
-    c_nodes: set of consumer nodes
-
-    normalized : bool, optional
-      If True the betweenness values are normalized by $2/(n(n-1))$
-      for graphs, and $1/(n(n-1))$ for directed graphs where $n$
-      is the number of nodes in G.
-
-    weight : None or string, optional (default=None)
-      If None, all edge weights are considered equal.
-      Otherwise holds the name of the edge attribute used as weight.
-
-    seed : integer, random_state, or None (default)
-        Indicator of random number generation state.
-        See :ref:`Randomness<randomness>`.
-        Note that this is only used if k is not None.
-
-    Returns
-    -------
-    edges : dictionary
-       Dictionary of edges with betweenness centrality as the value.
-
-
-    For weighted graphs the edge weights must be greater than zero.
-    Zero edge weights can produce an infinite number of equal length
-    paths between pairs of nodes.
-
-    """
-    betweenness = dict.fromkeys(G.nodes, 1.0)  # b[v]=0 for v in G
-    # b[e]=0 for e in G.edges()
-    if seed is None:
-        random.seed(seed)
-    betweenness.update(dict.fromkeys(G.nodes(), 1.0))
-    if k is None:
-        sample_s_nodes = s_nodes
-        sample_c_nodes = c_nodes
-    else:
-        sample_s_nodes = random.sample(s_nodes, min(k,len(s_nodes)))
-        sample_c_nodes = random.sample(c_nodes, min(k,len(c_nodes)))
-    for s in sample_s_nodes:
-        for c in sample_c_nodes:
-            if c!=s:
-                #shortest paths
-                if weight is None:  # use BFS
-                    sp = nx.shortest_path(G, source=s,target=c)
-                else:  # use Dijkstra's algorithm
-                    sp = nx.shortest_path(G,source=s,target=c,weight=weight)
-                    # accumulation
-                for i in range(0,len(sp)):
-                    betweenness[sp[i]] +=1
-    return betweenness
-    
-    
-def OD_edge_betweenness_centrality(G, s_nodes, c_nodes, k=None, normalized=True, weight=None,
-                                seed=None):
-    r"""Compute betweenness centrality for edges, considering paths between source and consumer nodes.
-    
-    This function is a modified version of networkx package function edge_betweenness_centrality()
-
-    Betweenness centrality of an edge $e$ is the sum of the
-    fraction of all-pairs shortest paths that pass through $e$
-
-    .. math::
-
-       c_B(e) =\sum_{s\in SV,t \in CV} \frac{\sigma(s, t|e)}{\sigma(s, t)}
-
-    where $SV$ is the set of source nodes, $CV$ is the set of consumer nodes,
-    $\sigma(s, t)$ is the number of shortest $(s, t)$-paths, and $\sigma(s, t|e)$ 
-    is the number of     those paths passing through edge $e$ [2]_.
+    One shortest path tree is computed per source node (Dijkstra's algorithm), and the
+    paths to all the consumer nodes are accumulated from the predecessors of that tree,
+    for nodes and edges at once.
 
     Parameters
     ----------
-    G : graph
-      A NetworkX graph.
+    net : Netcore.Network
+      Array representation of the network. The current edge weights are used.
 
     k : int, optional (default=None)
       If k is not None use k node samples to estimate betweenness.
@@ -322,49 +261,54 @@ def OD_edge_betweenness_centrality(G, s_nodes, c_nodes, k=None, normalized=True,
       for graphs, and $1/(n(n-1))$ for directed graphs where $n$
       is the number of nodes in G.
 
-    weight : None or string, optional (default=None)
-      If None, all edge weights are considered equal.
-      Otherwise holds the name of the edge attribute used as weight.
-
-    seed : integer, random_state, or None (default)
-        Indicator of random number generation state.
-        See :ref:`Randomness<randomness>`.
+    seed : integer, numpy SeedSequence or Generator, or None (default)
+        Indicator of random number generation state (see numpy.random.default_rng).
         Note that this is only used if k is not None.
 
     Returns
     -------
-    edges : dictionary
-       Dictionary of edges with betweenness centrality as the value.
+    nodes, edges : numpy arrays
+       Betweenness centrality of each node and each edge, indexed by node and edge id.
 
 
+    Removed edges (weight 1/EPS) are only used if there is no other path.
     For weighted graphs the edge weights must be greater than zero.
     Zero edge weights can produce an infinite number of equal length
     paths between pairs of nodes.
 
     """
-    betweenness = dict.fromkeys(G.edges, 1.0)  # b[v]=0 for v in G
-    # b[e]=0 for e in G.edges()
-    if seed is None:
-        random.seed(seed)
-    betweenness.update(dict.fromkeys(G.edges(), 1.0))
+    node_betweenness = np.ones(net.n_nodes)  # b[v]=1 for v in G
+    edge_betweenness = np.ones(net.n_edges)  # b[e]=1 for e in G.edges()
+    if len(s_nodes)==0 or len(c_nodes)==0:
+        return node_betweenness, edge_betweenness
     if k is None:
         sample_s_nodes = s_nodes
         sample_c_nodes = c_nodes
     else:
-        sample_s_nodes = random.sample(s_nodes, min(k,len(s_nodes)))
-        sample_c_nodes = random.sample(c_nodes, min(k,len(c_nodes)))
-    for s in sample_s_nodes:
-        for c in sample_c_nodes:
-            if c!=s:
-                #shortest paths
-                if weight is None:  # use BFS
-                    sp = nx.shortest_path(G, source=s,target=c)
-                else:  # use Dijkstra's algorithm
-                    sp = nx.shortest_path(G,source=s,target=c,weight=weight)
-                # accumulation
-                for i in range(0,len(sp)-1):
-                    try:
-                        betweenness[(sp[i],sp[i+1])] +=1
-                    except:
-                        betweenness[(sp[i+1],sp[i])] +=1
-    return betweenness
\ No newline at end of file
+        rng = np.random.default_rng(seed)
+        sample_s_nodes = rng.choice(s_nodes, min(k,len(s_nodes)), replace=False)
+        sample_c_nodes = rng.choice(c_nodes, min(k,len(c_nodes)), replace=False)
+    # shortest path trees with Dijkstra's algorithm, one row per source
+    dist, pred = scipy.sparse.csgraph.dijkstra(
+        net.weighted_adjacency(cutoff=0.5/cons.EPS), indices=sample_s_nodes, return_predecessors=True)
+    # all (source, consumer) pairs, as (tree row, current node of the path)
+    rows = np.repeat(np.arange(len(sample_s_nodes)), len(sample_c_nodes))
+    nodes = np.tile(np.asarray(sample_c_nodes, dtype=np.intp), len(sample_s_nodes))
+    keep = (nodes != np.asarray(sample_s_nodes)[rows]) & np.isfinite(dist[rows, nodes])
+    rows, nodes = rows[keep], nodes[keep]
+    # accumulation: walk all the paths back to their source at once, as flat indices row*n_nodes+node of the trees,
+    # and count the visited nodes and edges once at the end
+    parents = np.where(pred >= 0, pred + np.arange(len(pred))[:, np.newaxis] * net.n_nodes, -1).ravel()
+    path = rows * net.n_nodes + nodes
+    visits = [path]
+    while len(path) > 0:
+        path = parents[path]
+        # the source has no predecessor, that path is complete
+        path = path[path >= 0]
+        visits.append(path)
+    visits = np.concatenate(visits)
+    node_betweenness += np.bincount(visits % net.n_nodes, minlength=net.n_nodes)
+    # every visited node but the source is entered through the edge from its predecessor
+    visits = visits[parents[visits] >= 0]
+    edge_betweenness += np.bincount(net.edge_ids(parents[visits] % net.n_nodes, visits % net.n_nodes), minlength=net.n_edges)
+    return node_betweenness, edge_betweenness
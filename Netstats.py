@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Python module for the statistics of the Monte Carlo samples, accumulated while the samples are simulated.
+Contains the SampleStatistics class:
+    - Disruptions: (weighted) number of samples in which each consumer area has a blackout, and the moments of the
+    (weighted) disruption indicators, for the disruption probabilities and their standard errors
+    - Affected population: moments of the total population of the areas with a blackout, and its histogram (fixed bins
+    between 0 and the total population)
+    - Streaming: the samples are reduced in blocks of a fixed number of samples, whose moments are merged with the ones of
+    the previous blocks (Welford / Chan et al.), so that the memory does not grow with the number of samples and the results
+    do not depend on how the samples were split among the worker processes. Accumulators of parts of the samples can be merged
+    - Raw samples: optionally, the state of the areas of every sample (and its weight) is written to memory-mapped .npy files
+    - Save: the results are stored in a .npz file
+
+@author: hfrv2
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+class SampleStatistics():
+    '''
+    Streaming statistics of the states of the consumer areas (0 ok, 1 blackout) of the Monte Carlo samples,
+    with the likelihood ratios of importance sampling as weights (weighted=True).
+    '''
+
+    # number of bins of the histogram of the affected population
+    HISTOGRAM_BINS = 50
+    # number of samples reduced at once
+    BLOCK_SIZE = 256
+
+    def __init__(self, population, weighted=False, n_bins=HISTOGRAM_BINS, raw=None, raw_weights=None):
+        self.population = np.asarray(population)
+        self.weighted = weighted
+        # optional arrays (e.g. of open_raw) with one row per sample id, in which the added samples and weights are stored
+        self.raw = raw
+        self.raw_weights = raw_weights
+        n_areas = len(self.population)
+        self.n = 0
+        self.weight_sum = 0.0
+        self.weight_sq_sum = 0.0
+        # sums and sums of squared deviations of the (weighted) disruption indicators of the areas
+        self.area_sum = np.zeros(n_areas)
+        self.area_m2 = np.zeros(n_areas)
+        # same for the (weighted) affected population, and sum of the weighted squares
+        self.population_sum = 0.0
+        self.population_m2 = 0.0
+        self.population_sq_sum = 0.0
+        self.bin_edges = np.linspace(0.0, max(float(np.sum(self.population)), 1.0), n_bins + 1)
+        self.histogram = np.zeros(n_bins)
+        # samples added but not yet reduced
+        self._pending = []
+
+    @staticmethod
+    def open_raw(filename, n_samples, n_areas, weighted=False):
+        '''
+        Creates a memory-mapped .npy file for the raw samples (samples x areas, uint8), to be passed as raw,
+        and if weighted, one for their weights (filename with the suffix _weights), to be passed as raw_weights (otherwise None).
+        They can be read with np.load(filename, mmap_mode='r').
+        '''
+        raw = np.lib.format.open_memmap(filename, mode='w+', dtype=np.uint8, shape=(n_samples, n_areas))
+        raw_weights = None
+        if weighted:
+            root, ext = os.path.splitext(filename)
+            raw_weights = np.lib.format.open_memmap(root + '_weights' + (ext or '.npy'), mode='w+', dtype=float, shape=(n_samples,))
+        return raw, raw_weights
+
+    def add(self, sample_ids, samples, weights=None):
+        '''
+        Adds the states of the areas (matrix, one row per sample) of the samples with the given ids, in the order of the ids,
+        with their likelihood ratios (weights, only used if weighted).
+        '''
+        samples = np.asarray(samples, dtype=np.uint8)
+        if weights is None or not self.weighted:
+            weights = np.ones(len(samples))
+        if self.raw is not None and len(samples) > 0:
+            self.raw[np.asarray(sample_ids)] = samples
+        if self.raw_weights is not None and len(samples) > 0:
+            self.raw_weights[np.asarray(sample_ids)] = weights
+        self._pending.append((samples, np.asarray(weights, dtype=float)))
+        n_pending = sum(len(part[0]) for part in self._pending)
+        if n_pending >= self.BLOCK_SIZE:
+            samples = np.concatenate([part[0] for part in self._pending])
+            weights = np.concatenate([part[1] for part in self._pending])
+            n_blocks = n_pending // self.BLOCK_SIZE * self.BLOCK_SIZE
+            for start in range(0, n_blocks, self.BLOCK_SIZE):
+                self._reduce(samples[start:start + self.BLOCK_SIZE], weights[start:start + self.BLOCK_SIZE])
+            self._pending = [(samples[n_blocks:], weights[n_blocks:])]
+
+    def flush(self):
+        '''
+        Reduces the pending samples (done by the results; later samples then start a new block).
+        '''
+        pending, self._pending = self._pending, []
+        if pending:
+            # one block, whatever the parts in which the samples were added
+            self._reduce(np.concatenate([part[0] for part in pending]), np.concatenate([part[1] for part in pending]))
+
+    def merge(self, other):
+        '''
+        Adds the statistics of another accumulator of the same areas (for instance of other samples).
+        '''
+        other.flush()
+        self.flush()
+        self._combine(other)
+
+    def _combine(self, other):
+        # adds the reduced statistics of other
+        if other.n == 0:
+            return
+        n = self.n + other.n
+        if self.n > 0:
+            # pairwise combination of the sums of squared deviations (Chan et al.)
+            factor = self.n * other.n / n
+            area_delta = other.area_sum / other.n - self.area_sum / self.n
+            population_delta = other.population_sum / other.n - self.population_sum / self.n
+            self.area_m2 += other.area_m2 + area_delta**2 * factor
+            self.population_m2 += other.population_m2 + population_delta**2 * factor
+        else:
+            self.area_m2 = other.area_m2.copy()
+            self.population_m2 = other.population_m2
+        self.n = n
+        self.weight_sum += other.weight_sum
+        self.weight_sq_sum += other.weight_sq_sum
+        self.area_sum = self.area_sum + other.area_sum
+        self.population_sum += other.population_sum
+        self.population_sq_sum += other.population_sq_sum
+        self.histogram += other.histogram
+
+    def _reduce(self, samples, weights):
+        # statistics of a block, merged into the accumulated ones
+        if len(samples) == 0:
+            return
+        block = SampleStatistics(self.population, self.weighted, len(self.histogram))
+        affected_population = samples.dot(self.population)
+        values = samples * weights[:, np.newaxis]
+        population_values = affected_population * weights
+        block.n = len(samples)
+        block.weight_sum = float(np.sum(weights))
+        block.weight_sq_sum = float(np.sum(np.square(weights)))
+        block.area_sum = np.sum(values, axis=0)
+        block.area_m2 = np.sum(np.square(values - block.area_sum / block.n), axis=0)
+        block.population_sum = float(np.sum(population_values))
+        block.population_m2 = float(np.sum(np.square(population_values - block.population_sum / block.n)))
+        block.population_sq_sum = float(np.sum(weights * np.square(affected_population, dtype=float)))
+        block.histogram = np.histogram(affected_population, bins=self.bin_edges, weights=weights)[0]
+        self._combine(block)
+
+    def prob(self):
+        '''
+        Returns the disruption probability of each area (the weighted mean of the samples, if weighted).
+        '''
+        self.flush()
+        return self.area_sum / self.n
+
+    def se_prob(self):
+        '''
+        Returns the standard error of the disruption probability of each area
+        (binomial, or from the variance of the weighted samples if weighted).
+        '''
+        prob = self.prob()
+        if not self.weighted:
+            return np.sqrt(prob * (1 - prob) / self.n)
+        if self.n < 2:
+            return np.full(len(prob), np.inf)
+        return np.sqrt(self.area_m2 / (self.n - 1)) / np.sqrt(self.n)
+
+    def population_moments(self):
+        '''
+        Returns the mean and the standard deviation of the affected population
+        (if weighted, the weighted means of the population and of its square).
+        '''
+        self.flush()
+        mean = self.population_sum / self.n
+        if not self.weighted:
+            return mean, np.sqrt(self.population_m2 / self.n)
+        return mean, np.sqrt(max(0.0, self.population_sq_sum / self.n - mean**2))
+
+    def se_population(self):
+        '''
+        Returns the standard error of the mean (weighted) affected population.
+        '''
+        self.flush()
+        if self.n < 2:
+            return np.inf
+        return np.sqrt(self.population_m2 / (self.n - 1)) / np.sqrt(self.n)
+
+    def save(self, file, area_names=None):
+        '''
+        Saves the results (disruption probabilities and their standard errors, number of samples, moments of the
+        affected population and its histogram) in .npz format, with the names of the areas (as json) if given.
+        The file can be a name or a file object.
+        '''
+        mean, std = self.population_moments()
+        arrays = {
+            'prob': self.prob(),
+            'se_prob': self.se_prob(),
+            'n_samples': np.array(self.n),
+            'effective_samples': np.array(self.effective_samples()),
+            'weighted': np.array(self.weighted),
+            'population': self.population,
+            'mean_affected_population': np.array(mean),
+            'std_affected_population': np.array(std),
+            'se_affected_population': np.array(self.se_population()),
+            'histogram': self.histogram,
+            'bin_edges': self.bin_edges}
+        if area_names is not None:
+            arrays['area_names'] = np.array(json.dumps(list(area_names)))
+        np.savez(file, **arrays)
+
+    def effective_samples(self):
+        '''
+        Returns the effective number of samples (lower than the number of samples if weighted).
+        '''
+        self.flush()
+        if not self.weighted or self.weight_sq_sum <= 0:
+            return float(self.n)
+        return self.weight_sum**2 / self.weight_sq_sum
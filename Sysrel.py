@@ -1,164 +1,515 @@
 # -*- coding: utf-8 -*-
 """
 Python module for system reliability. Contains the functions directly called by the main file:
-    - Load Network Data: Creates a graph object based on the line exposure and node damage information (i.e. prob. of failure). 
+    - Load Network Data: Creates the network based on the line exposure and node damage information (i.e. prob. of failure), from their columns (Netexposure). 
     Network fragility defines which node taxonomy corresponds to source and consumer nodes
     - Evaluate System Loads: estimates the loads at nodes and edges, based on shortest path algorithm between source and consumer nodes
     - Assign Initial Capacities: assign capacities to nodes and edges based on precomputed loads and a given safety factor
-    - Monte Carlo Simulation: simulates the hazard action and cascading effects for multiple random nodal damage states
+    - Common Random Numbers: draws, saves and loads the uniform random numbers of the direct hazard action (samples x components), 
+    for comparing scenarios with the same random failures
+    - Save and Load Network Data: stores the network with its initial loads and capacities in a file, and loads it
+    with the probabilities of failure of a new node damage (these steps do not depend on the hazard)
+    - Monte Carlo Simulation: simulates the hazard action and cascading effects for multiple random nodal damage states (optionally 
+    distributed over a pool of worker processes, with one independent random stream per sample). The states of the consumer areas
+    (0 ok, 1 blackout) are reduced to their statistics as the samples complete (Netstats.SampleStatistics), and optionally stored
+    - Adaptive Monte Carlo Simulation: runs batches of samples until the standard errors of the estimates are small enough
+    - Fast path: samples without failures, or whose failures cannot affect any consumer (parts of the network that are only
+    connected to the rest through bridges, without sources nor consumers), take the state of the consumer areas of the undamaged network
+    - Failure set cache: with a Netcache.FailureSetCache, samples with the same failed components reuse the state of the consumer
+    areas of an earlier sample, instead of simulating the cascading effects again
+    - Importance Sampling: raises the small probabilities of failure for sampling the rare disruptions, each sample is weighted
+    by its likelihood ratio (the weighted estimates are unbiased)
     - Compute output: based on the samples, returns sample of global values (total affected population) and probability of affectation for 
-    each consumer area
+    each consumer area (with confidence intervals), from the statistics of the samples
 
 Created on Tue Aug 13 10:52:00 2019
 
 @author: hfrv2
 """
 
+import json
 import numpy as np
-import networkx as nx
-import copy
+import multiprocessing
+import os
+import time
 import Constants as cons
+import Netcore
+import Netexposure
 import Netsim as ns
+import Netstats
+
+#numeric properties of the lines used by the network (NaN if they are missing)
+LINE_VALUES=(cons.LENGTH,cons.REACTANCE,cons.RESISTANCE,cons.VOLTAGE,cons.LINE_POF)
+#formulas of the line weights, in order of preference: name, property and combination with the length (see line_weights)
+LINE_WEIGHTS=(
+    ('length*reactance',cons.REACTANCE,np.multiply),
+    ('length*resistance',cons.RESISTANCE,np.multiply),
+    ('length/voltage',cons.VOLTAGE,np.divide))
+#largest number of samples simulated at once (a chunk of run_Monte_Carlo_simulation), a few blocks of the statistics:
+#the memory of the random streams and of the failure matrices of a chunk does not grow with the number of samples
+MAX_CHUNK_SIZE=4*Netstats.SampleStatistics.BLOCK_SIZE
 ##### ----------------------------- Functions called in the main file ---------------------------------########
 
-'''Create the graph from geojson files''' 
+'''Create the network from the geojson data, in a single pass over the features of the nodes and of the lines (see Netexposure);
+ExposureLines can also be the columns of the line exposure (Netexposure.ExposureColumns, e.g. loaded from the sidecar file)'''
 def load_network_data(DamageNodes,ExposureLines,NetworkFragility):
-    G=nx.Graph()#initialize graph
-    EdgesFea=ExposureLines[cons.FEATURES]#extract edge features
-    NodesFea=DamageNodes[cons.FEATURES] #extract node features
-    #Initialize attributes for nodes and edges
-    NodeBunch={NodesFea[i][cons.PROPERTIES][cons.NODE_NAME]:{
-            cons.TAXONOMY:'',
-            cons.COORDINATES:NodesFea[i][cons.GEOMETRY][cons.COORDINATES],
-            cons.NODE_DAMAGE:0.0,
-            cons.NODE_DELTADAMAGE:0.0,
-            cons.NODE_POF:0.0
-            } for i in range(0,len(NodesFea))}
-    EdgeBunch=[(EdgesFea[i][cons.PROPERTIES][cons.FROM],EdgesFea[i][cons.PROPERTIES][cons.TO],{
-            cons.LINE_NAME:'',
-            cons.LENGTH:1.0,
-            cons.COORDINATES:EdgesFea[i][cons.GEOMETRY][cons.COORDINATES],
-            cons.VOLTAGE:1.0,
-            cons.WEIGHT:1.0,
-            cons.RESISTANCE:1.0,
-            cons.REACTANCE:1.0,
-            cons.LINE_DAMAGE:0.0,
-            cons.LINE_DELTADAMAGE:0.0,
-            cons.LOAD:1.0,
-            cons.CAPACITY:1.0
-            }) for i in range(0,len(EdgesFea))]
-    # add edges to G (nodes are initialized too, without attributes)
-    G.add_edges_from(EdgeBunch)
-    del EdgeBunch# save memory
-    # add attributes to the initialized nodes     
-    nx.set_node_attributes(G,NodeBunch)
-    #set node attributes (only from 'properties' key)
-    for attr in NodesFea[0][cons.PROPERTIES].keys():
-        if attr==cons.NODE_NAME:
-           continue
-        NodeAttr={NodesFea[i][cons.PROPERTIES][cons.NODE_NAME]:{attr:NodesFea[i][cons.PROPERTIES][attr]} for i in range(0,len(NodesFea))}
-        nx.set_node_attributes(G,NodeAttr)
-    #set edge attributes (only from 'properties' key)
-    for attr in EdgesFea[0][cons.PROPERTIES].keys():
-        EdgeAttr={(EdgesFea[i][cons.PROPERTIES][cons.FROM],EdgesFea[i][cons.PROPERTIES][cons.TO]):{attr:EdgesFea[i][cons.PROPERTIES][attr]} for i in range(0,len(EdgesFea))}
-        nx.set_edge_attributes(G,EdgeAttr)
-    #update the weights; depending on available data 
-    EdgeWeights={}
-    #try the desired case: weightL*X, (L*sqrt(R^2+X^2), R<<X), R: resistance, X: reactance
-    try:
-        #EdgeWeights={(EdgesFea[i][cons.PROPERTIES][cons.FROM],EdgesFea[i][cons.PROPERTIES][cons.TO]):
-            #{cons.WEIGHT:float(EdgesFea[i][cons.PROPERTIES][cons.LENGTH])*
-            # np.sqrt((float(EdgesFea[i][cons.PROPERTIES][cons.REACTANCE])**2+
-             #         float(EdgesFea[i][cons.PROPERTIES][cons.RESISTANCE])**2))} for i in range(0,len(EdgesFea))}
-        EdgeWeights={(EdgesFea[i][cons.PROPERTIES][cons.FROM],EdgesFea[i][cons.PROPERTIES][cons.TO]):
-                {cons.WEIGHT:float(EdgesFea[i][cons.PROPERTIES][cons.LENGTH])*
-                 float(EdgesFea[i][cons.PROPERTIES][cons.REACTANCE])} for i in range(0,len(EdgesFea))}
-    except:
-        #otherwise, try just with the resistance: weight=L*R
-        try:
-            EdgeWeights={(EdgesFea[i][cons.PROPERTIES][cons.FROM],EdgesFea[i][cons.PROPERTIES][cons.TO]):
-                {cons.WEIGHT:float(EdgesFea[i][cons.PROPERTIES][cons.LENGTH])*
-                 float(EdgesFea[i][cons.PROPERTIES][cons.RESISTANCE])} for i in range(0,len(EdgesFea))}
-        #otherwise, just assume weight~length/voltage
-        except:
-            EdgeWeights={(EdgesFea[i][cons.PROPERTIES][cons.FROM],EdgesFea[i][cons.PROPERTIES][cons.TO]):
-                {cons.WEIGHT:float(EdgesFea[i][cons.PROPERTIES][cons.LENGTH])/(float(EdgesFea[i][cons.PROPERTIES][cons.VOLTAGE]))} for i in range(0,len(EdgesFea))}
-    nx.set_edge_attributes(G,EdgeWeights)
-    # create a dictionary of node lists by taxonomy
-    Types=nx.get_node_attributes(G,cons.NODE_TYPE)
+    if not isinstance(ExposureLines,Netexposure.ExposureColumns):
+        ExposureLines=Netexposure.ExposureColumns.from_features(ExposureLines[cons.FEATURES],value_keys=LINE_VALUES,lines=True)
+    Nodes=node_columns(DamageNodes)
+    EdgeWeights,counts=line_weights(ExposureLines)
+    if counts[LINE_WEIGHTS[0][0]]<len(ExposureLines):
+        print('Line weights: '+', '.join('{0} lines {1}'.format(counts[name],name) for name,_,_ in LINE_WEIGHTS))
+    net=Netcore.Network.from_exposure(Nodes,ExposureLines,EdgeWeights)
+    # create lists of source and terminal node ids by taxonomy
     source=NetworkFragility[cons.META][cons.SOURCE]
     terminal=NetworkFragility[cons.META][cons.TERMINAL]
-    s_nodes=[nod for nod in G.nodes() if Types[nod] in source]
-    t_nodes=[nod for nod in G.nodes() if Types[nod] in terminal]
-    return G,s_nodes,t_nodes
+    s_nodes=[nod for nod in range(0,net.n_nodes) if net.node_taxonomy[nod] in source]
+    t_nodes=[nod for nod in range(0,net.n_nodes) if net.node_taxonomy[nod] in terminal]
+    return net,s_nodes,t_nodes
+
+'''Columns of the node damage, with the probabilities of failure as values'''
+def node_columns(DamageNodes):
+    return Netexposure.ExposureColumns.from_features(DamageNodes[cons.FEATURES],name_key=cons.NODE_NAME,value_keys=(cons.NODE_POF,))
+
+'''Weights of the lines (columns of the line exposure); depending on the available data of each line: length*reactance
+(L*sqrt(R^2+X^2), R<<X), otherwise length*resistance, otherwise length/voltage (see LINE_WEIGHTS)
+returns the weights and the number of lines of each formula, by name'''
+def line_weights(Lines):
+    weights=np.full(len(Lines),np.nan)
+    counts={}
+    for name,key,combine in LINE_WEIGHTS:
+        with np.errstate(divide='ignore',invalid='ignore'):#zero voltages give no weight
+            values=combine(Lines.values[cons.LENGTH],Lines.values[key])
+        mask=np.isnan(weights)&np.isfinite(values)
+        weights[mask]=values[mask]
+        counts[name]=int(np.sum(mask))
+    if np.any(np.isnan(weights)):
+        raise ValueError('{0} lines have no length and reactance, resistance or voltage'.format(int(np.sum(np.isnan(weights)))))
+    return weights,counts
 
 '''evaluation of system loads
 load is computed as the number of shortest paths that pass through the component (node or edge)'''
-def evaluate_system_loads(G,s_nodes,t_nodes):
-    ns.evaluate_system_loads(G,s_nodes,t_nodes)
+def evaluate_system_loads(G,s_nodes,t_nodes,seed=None):
+    ns.evaluate_system_loads(G,s_nodes,t_nodes,seed=seed)
 
 '''Assign component capacities'''
 def assign_initial_capacities(G,alpha):
-    node_caps={no:{cons.CAPACITY:alpha*G.nodes[no][cons.LOAD]} for no in G.nodes()}
-    edge_caps={ed:{cons.CAPACITY:alpha*G.edges[ed][cons.LOAD]} for ed in G.edges()}
-    nx.set_node_attributes(G,node_caps)
-    nx.set_edge_attributes(G,edge_caps)
-
-'''MONTE CARLO SIMULATION''' 
-def run_Monte_Carlo_simulation(Graph,s_nodes0,t_nodes0,ExposureConsumerAreas,mcs):
-    #component_state_dha=[]
-    #component_state_idp=[]
-    #store samples of affected areas in a list
-    affected_areas=[]
-    max_iteration=5#max number of iterations in simulation of cascading effects
+    G.node_cap[:]=alpha*G.node_load
+    G.edge_cap[:]=alpha*G.edge_load
+
+'''Save the network with its initial loads and capacities (.npz file)
+the file is written under a temporary name first, so that concurrent runs never read a partial file'''
+def save_network_data(filename,G,s_nodes,t_nodes):
+    tmp_filename=filename+'.'+str(os.getpid())+'.tmp'
+    with open(tmp_filename,'wb') as f:
+        G.save(f,s_nodes=np.array(s_nodes,dtype=np.intp),t_nodes=np.array(t_nodes,dtype=np.intp))
+    os.replace(tmp_filename,filename)
+
+'''Load a network saved by save_network_data
+the probabilities of failure are taken from the node damage'''
+def load_saved_network_data(filename,DamageNodes):
+    net,extra=Netcore.Network.load(filename)
+    assign_node_pof(net,DamageNodes)
+    return net,extra['s_nodes'].tolist(),extra['t_nodes'].tolist()
+
+'''Assign the probabilities of failure of a node damage to a network, by node name, as load_network_data does
+(nodes missing from the node damage or without probability of failure get 0)'''
+def assign_node_pof(G,DamageNodes):
+    G.set_node_pof(node_columns(DamageNodes))
+
+'''COMMON RANDOM NUMBERS
+uniform random numbers of the direct hazard action, one row per sample and one column per component: first the nodes
+(in the order of G.node_names), then the lines (in the order of G.edge_names()).
+In sample i, a component fails if its number is below its probability of failure; scenarios simulated with the same matrix
+have the same random failures (a node that fails in one scenario also fails with a larger probability of failure),
+which reduces the variance of the differences between their results''' 
+def draw_common_random_numbers(G,n_samples,seed=None):
+    rng=np.random.default_rng(seed)
+    node_uniforms=rng.random((n_samples,G.n_nodes))
+    edge_uniforms=rng.random((n_samples,G.n_edges))
+    return np.hstack((node_uniforms,edge_uniforms))
+
+'''Save the common random numbers with the node and line names (.npz file), for reproducing the samples later'''
+def save_common_random_numbers(filename,uniforms,G):
+    with open(filename,'wb') as f:
+        np.savez(f,uniforms=uniforms,node_names=np.array(json.dumps(G.node_names)),edge_names=np.array(json.dumps(G.edge_names())))
+
+'''Load common random numbers saved by save_common_random_numbers, with the columns in the node and line order of the network
+(lines are matched by the names of their nodes, in any direction)'''
+def load_common_random_numbers(filename,G):
+    with np.load(filename,allow_pickle=False) as data:
+        node_names=json.loads(str(data['node_names']))
+        edge_names=json.loads(str(data['edge_names']))
+        uniforms=data['uniforms']
+    column={name:i for i,name in enumerate(node_names)}
+    for i,(u,v) in enumerate(edge_names):
+        column[(u,v)]=column[(v,u)]=len(node_names)+i
+    keys=list(G.node_names)+[tuple(edge) for edge in G.edge_names()]
+    missing=[key for key in keys if key not in column]
+    if len(missing)>0:
+        raise ValueError('The common random numbers of '+filename+' do not contain the components: '+', '.join(str(key) for key in missing))
+    return uniforms[:,[column[key] for key in keys]]
+
+'''IMPORTANCE SAMPLING
+biased probabilities of failure (of the nodes, and of the lines with line_fragility) for sampling the direct hazard action:
+the uncertain probabilities p are scaled by a common factor c (but not above max_pof, nor below p), such that the expected number
+of failed uncertain components is target_failures. Certain failures and certainly working components are not changed, nor are
+the probabilities if the expected number of failures is already larger. Returns the biased probabilities of the nodes and
+of the lines (None without line_fragility)'''
+def importance_sampling_pof(Graph,target_failures=1.0,line_fragility=False,max_pof=cons.IS_MAX_POF):
+    pof=np.concatenate((Graph.node_pof,Graph.edge_pof)) if line_fragility else Graph.node_pof
+    uncertain=(pof>=cons.EPS)&(pof<=1-cons.EPS)
+    p=pof[uncertain]
+    def biased_pof(c):
+        return np.maximum(p,np.minimum(max_pof,c*p))
+    c=1.0
+    if len(p)>0 and np.sum(p)<target_failures:
+        # all uncertain components at max_pof (or above)
+        c_high=max_pof/np.min(p)
+        if np.sum(biased_pof(c_high))<=target_failures:
+            c=c_high
+        else:
+            # bisection of the (monotonic) expected number of failures, on a logarithmic scale
+            c_low=1.0
+            for _ in range(100):
+                c=np.sqrt(c_low*c_high)
+                if np.sum(biased_pof(c))<target_failures:
+                    c_low=c
+                else:
+                    c_high=c
+            c=c_high
+    sampling_pof=pof.copy()
+    sampling_pof[uncertain]=biased_pof(c)
+    if line_fragility:
+        return sampling_pof[:Graph.n_nodes],sampling_pof[Graph.n_nodes:]
+    return sampling_pof,None
+
+'''MONTE CARLO SIMULATION
+The network state arrays are reset in place before each sample.
+Sample i uses its own random stream, the child i of the seed (integer or numpy SeedSequence),
+hence the results for a given seed do not depend on the number of worker processes.
+With common random numbers (uniforms), sample i takes the failures of the direct hazard action from the row i.
+With line_fragility=True, the lines fail with their probabilities of failure too.
+With importance sampling, the failures are sampled with the probabilities sampling_pof (see importance_sampling_pof).
+stats: optional Netstats.SampleStatistics, to which the samples are added (otherwise a new one, weighted with importance sampling).
+cache: optional Netcache.FailureSetCache of the outages of the failure sets; each worker process uses a copy of it,
+and their hits and misses are added to it.
+With fast_path=True, the samples that cannot affect any consumer are not simulated (see fast_path_data); the results are the same.
+baseline: optional result of fast_path_data for this network (computed here if it is not given), for callers that simulate several batches.
+pool: optional pool of worker processes of make_worker_pool with the same arguments (and baseline), reused by such callers;
+otherwise, with workers>1, a pool is created for this call.
+Returns the statistics of the samples''' 
+def run_Monte_Carlo_simulation(Graph,s_nodes0,t_nodes0,ExposureConsumerAreas,mcs,seed=None,workers=1,first_sample=0,uniforms=None,
+                               line_fragility=False,sampling_pof=None,stats=None,cache=None,fast_path=True,baseline=None,pool=None):
+    seed_sequence=seed if isinstance(seed,np.random.SeedSequence) else np.random.SeedSequence(seed)
+    if uniforms is not None and len(uniforms)<first_sample+mcs:
+        raise ValueError('Not enough common random numbers: '+str(len(uniforms))+' samples for '+str(first_sample+mcs))
+    #statistics of the affected areas, updated with every chunk of samples
+    if stats is None:
+        stats=Netstats.SampleStatistics(area_population(ExposureConsumerAreas),weighted=sampling_pof is not None)
+    chunks=sample_chunks(first_sample,mcs,workers)
+    if not fast_path:
+        baseline=None
+    elif baseline is None:
+        baseline=fast_path_data(Graph,s_nodes0,t_nodes0,ExposureConsumerAreas)
     # here starts the MCS
-    for i in range(0,mcs):
-        i_component_state_dha={}
-        #i_component_state_casc={}
-        #modify the network in a copy
-        NetG=copy.deepcopy(Graph)
-        #likewise for the source and terminal list
-        s_nodes=copy.deepcopy(s_nodes0)
-        t_nodes=copy.deepcopy(t_nodes0)
-        ## Direct Hazard Action
-        # Simulate effects of hazard action on components
-        ns.direct_hazard_action(NetG)
-        
-        # store coponent damage states
-        i_component_state_dha={cons.NODES:nx.get_node_attributes(NetG,cons.NODE_DAMAGE),cons.EDGES:nx.get_edge_attributes(NetG,cons.LINE_DAMAGE)}
-        #component_state_dha.append(i_component_state_dha)
+    if workers>1 or pool is not None:
+        own_pool=pool is None
+        if own_pool:
+            pool=make_worker_pool(workers,Graph,s_nodes0,t_nodes0,ExposureConsumerAreas,uniforms,line_fragility,sampling_pof,cache,baseline)
+        try:
+            for chunk,(chunk_areas,chunk_weights,cache_stats) in zip(chunks,pool.imap(_simulate_chunk,[(chunk,seed_sequence) for chunk in chunks])):
+                _collect_samples(chunk,(chunk_areas,chunk_weights),stats)
+                if cache is not None:
+                    cache.add_stats(cache_stats,worker=cache_stats['worker'])
+        finally:
+            if own_pool:
+                pool.terminate()
+    else:
+        for chunk in chunks:
+            chunk_samples=simulate_samples(Graph,s_nodes0,t_nodes0,ExposureConsumerAreas,chunk,seed_sequence,uniforms,line_fragility,sampling_pof,
+                                           cache,baseline)
+            _collect_samples(chunk,chunk_samples,stats)
+                     
+    return stats
+
+'''Splits the samples first_sample, ..., first_sample+mcs-1 into chunks (ranges of sample ids): a few chunks per worker, for balancing
+the load, of at most MAX_CHUNK_SIZE samples'''
+def sample_chunks(first_sample,mcs,workers=1):
+    chunk_size=max(1,min(MAX_CHUNK_SIZE,int(np.ceil(mcs/(4.0*workers)))))
+    last_sample=first_sample+mcs
+    return [range(start,min(start+chunk_size,last_sample)) for start in range(first_sample,last_sample,chunk_size)]
+
+'''ADAPTIVE MONTE CARLO SIMULATION
+Runs batches of samples until the standard error of the disruption probability of every consumer area is below tol_prob,
+and the standard error of the mean affected population relative to that mean is below tol_population.
+The standard errors of the probabilities are the ones of their confidence intervals (see prob_standard_errors), which do not vanish
+when no disruption (or only disruptions) is observed; the relative standard error of the population is undefined, and the
+simulation goes on, as long as no disruption is observed.
+The simulation stops earlier if max_samples are simulated, or if max_time (seconds) is exceeded.
+Samples have the same ids (and random streams) as in run_Monte_Carlo_simulation.
+Returns the statistics of the samples (added to stats, if given)'''
+def run_adaptive_Monte_Carlo_simulation(Graph,s_nodes0,t_nodes0,ExposureConsumerAreas,batch_size,max_samples,tol_prob,tol_population,
+                                        max_time=None,seed=None,workers=1,uniforms=None,line_fragility=False,sampling_pof=None,stats=None,
+                                        cache=None):
+    start_time=time.time()
+    # the same master seed for all batches
+    seed_sequence=seed if isinstance(seed,np.random.SeedSequence) else np.random.SeedSequence(seed)
+    if stats is None:
+        stats=Netstats.SampleStatistics(area_population(ExposureConsumerAreas),weighted=sampling_pof is not None)
+    # the fast path data of the network and the worker processes, the same for all batches
+    baseline=fast_path_data(Graph,s_nodes0,t_nodes0,ExposureConsumerAreas)
+    pool=None
+    if workers>1:
+        pool=make_worker_pool(workers,Graph,s_nodes0,t_nodes0,ExposureConsumerAreas,uniforms,line_fragility,sampling_pof,cache,baseline)
+    try:
+        n_samples=0
+        while n_samples<max_samples:
+            n_batch=min(batch_size,max_samples-n_samples)
+            run_Monte_Carlo_simulation(Graph,s_nodes0,t_nodes0,ExposureConsumerAreas,n_batch,seed=seed_sequence,workers=workers,
+                                       first_sample=n_samples,uniforms=uniforms,line_fragility=line_fragility,sampling_pof=sampling_pof,
+                                       stats=stats,cache=cache,baseline=baseline,pool=pool)
+            n_samples+=n_batch
+            se_prob=np.max(prob_standard_errors(stats),initial=0.0)
+            mean_population=stats.population_moments()[0]
+            se_population=stats.se_population()/mean_population if mean_population>0 else np.inf
+            print("MCS samples: "+str(n_samples)+", max. std. error of disruption probability: "+str(se_prob)+
+                  ", relative std. error of affected population: "+str(se_population))
+            if se_prob<=tol_prob and se_population<=tol_population:
+                break
+            if max_time is not None and time.time()-start_time>max_time:
+                print("MCS time budget exceeded")
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return stats
+
+'''Standard error of the disruption probability of each area, for the stopping rule of the adaptive simulation: the largest distance
+between the estimate and the bounds of its 95% confidence interval in compute_output (Wilson score interval), divided by Z_95.
+With importance sampling, the larger of the standard error of the weighted estimate and the one of the Wilson interval
+of the effective number of samples (the former is 0 for the areas without observed disruptions)'''
+def prob_standard_errors(stats):
+    prob=stats.prob()
+    n=stats.effective_samples()
+    se_prob=np.zeros(len(prob))
+    for i_area,est_apof in enumerate(np.clip(prob,0.0,1.0)):
+        ci_low,ci_high=binomial_confidence_interval(est_apof,n)
+        se_prob[i_area]=max(ci_high-est_apof,est_apof-ci_low)/cons.Z_95
+    if stats.weighted:
+        se_prob=np.maximum(se_prob,stats.se_prob())
+    return se_prob
+
+'''Simulates the samples with the given ids, returns the affected areas (uint8 matrix, one row per sample) and the array of their likelihood ratios
+the failures of the direct hazard action are sampled for all the samples at once, and applied row by row.
+With a cache, the cascading effects of a failure set use a random stream derived from the set (not the one of the sample),
+hence a sample whose failure set is in the cache takes its affected areas without simulation.
+With the baseline of fast_path_data, the samples whose failed components are all inert take the baseline affected areas'''
+def simulate_samples(Graph,s_nodes0,t_nodes0,ExposureConsumerAreas,sample_ids,seed_sequence,uniforms=None,line_fragility=False,
+                     sampling_pof=None,cache=None,baseline=None):
+    # state of the unperturbed network
+    initial_state=Graph.copy_state()
+    sample_ids=list(sample_ids)
+    consumers=ns.consumer_incidence(ExposureConsumerAreas,Graph)
+    affected_areas=np.zeros((len(sample_ids),len(consumers[0])),dtype=np.uint8)
+    # independent random stream of each sample
+    rngs=[np.random.default_rng(np.random.SeedSequence(seed_sequence.entropy,spawn_key=tuple(seed_sequence.spawn_key)+(i,))) for i in sample_ids]
+    # failure matrices of the direct hazard action; each stream draws the numbers of the nodes, then of the lines
+    if uniforms is None:
+        node_uniforms=ns.draw_uniforms(Graph.node_pof,rngs)
+        edge_uniforms=ns.draw_uniforms(Graph.edge_pof,rngs) if line_fragility else None
+    else:
+        node_uniforms=uniforms[sample_ids,:Graph.n_nodes]
+        edge_uniforms=uniforms[sample_ids,Graph.n_nodes:] if line_fragility else None
+    node_pof,edge_pof=(Graph.node_pof,Graph.edge_pof) if sampling_pof is None else sampling_pof
+    node_failures=ns.sample_failures(node_pof,node_uniforms)
+    edge_failures=ns.sample_failures(edge_pof,edge_uniforms) if line_fragility else None
+    # likelihood ratio of each sample (1 without importance sampling)
+    weights=np.ones(len(sample_ids))
+    if sampling_pof is not None:
+        weights*=ns.likelihood_ratios(Graph.node_pof,node_pof,node_failures)
+        if line_fragility:
+            weights*=ns.likelihood_ratios(Graph.edge_pof,edge_pof,edge_failures)
+    # samples without failures of components that can affect the consumers
+    unaffected=np.zeros(len(sample_ids),dtype=bool)
+    if baseline is not None:
+        baseline_areas,inert_nodes,inert_edges=baseline
+        unaffected=~np.any(node_failures&~inert_nodes,axis=1)
+        if line_fragility:
+            unaffected&=~np.any(edge_failures&~inert_edges,axis=1)
+    for row,i in enumerate(sample_ids):
+        rng=rngs[row]
+        if unaffected[row]:
+            affected_areas[row]=baseline_areas
+            continue
+        if cache is not None:
+            key=cache.key(node_failures[row],edge_failures[row] if line_fragility else None)
+            cached_areas=cache.get(key)
+            if cached_areas is not None:
+                affected_areas[row]=cached_areas
+                continue
+            rng=np.random.default_rng(cache.seed_sequence(seed_sequence,key))
+        affected_areas[row]=simulate_sample(Graph,s_nodes0,t_nodes0,ExposureConsumerAreas,initial_state,
+                                            node_failures[row],edge_failures[row] if line_fragility else None,rng,consumers)
+        if cache is not None:
+            cache.put(key,affected_areas[row])
+    # leave the network in its unperturbed state
+    Graph.restore_state(initial_state)
+    return affected_areas,weights
+
+'''Simulates one sample with the given failures of the direct hazard action, starting from the unperturbed state of the network.
+Returns the affected areas (the network is left in the perturbed state); consumers: optional index of the areas (see Netsim.consumer_incidence)'''
+def simulate_sample(Graph,s_nodes0,t_nodes0,ExposureConsumerAreas,initial_state,node_failures,edge_failures=None,rng=None,consumers=None):
+    max_iteration=5#max number of iterations in simulation of cascading effects
+    #modify the network in place, starting from the unperturbed state
+    Graph.restore_state(initial_state)
+    #likewise for the source and terminal list
+    s_nodes=list(s_nodes0)
+    t_nodes=list(t_nodes0)
+    ## Direct Hazard Action
+    # Simulate effects of hazard action on components
+    ns.direct_hazard_action(Graph,node_failures,edge_failures)
+    
+    # largest component damage after the hazard action
+    max_damage_dha=max(np.max(Graph.node_dam,initial=0.0),np.max(Graph.edge_dam,initial=0.0))
+    
+    # Update network description: weights and capacities, and remove damaged nodes from source and terminal lists
+    ns.update_network(Graph,s_nodes,t_nodes)    
+
+    # if at least one component has significant damage, we simulate cascading effects
+    if max_damage_dha>cons.MIN_DAMAGE:
+        ## Damage Propagation
+        # if there are surviving source and terminal nodes
+        if len(s_nodes)>0 and len(t_nodes)>0:
+            # cascading effects
+            ns.simulate_cascading_effects(Graph,s_nodes,t_nodes,max_iteration,seed=rng)
+        #otherwise, loss of functionality, i.e. no more flow in network
+        # in any case, update the network
+        ns.update_network(Graph,s_nodes,t_nodes)                         
+              
+    # otherwise, no disconnection or cascading failures in this network              
         
-        # Update network description: weights and capacities, and remove damaged nodes from source and terminal lists
-        ns.update_network(NetG,s_nodes,t_nodes)    
-
-        # if at least one component has significant damage, we simulate cascading effects
-        if max(i_component_state_dha[cons.NODES].values())>cons.MIN_DAMAGE or max(i_component_state_dha[cons.EDGES].values())>cons.MIN_DAMAGE:
-            #i_component_state_casc=i_component_state_dha
-            ## Damage Propagation
-            # if there are surviving source and terminal nodes
-            if len(s_nodes)>0 and len(t_nodes)>0:
-                # cascading effects
-                ns.simulate_cascading_effects(NetG,s_nodes,t_nodes,max_iteration)
-            #otherwise, loss of functionality, i.e. no more flow in network
-            # in any case, update the network
-            ns.update_network(NetG,s_nodes,t_nodes)                         
-                  
-        # otherwise, no disconnection or cascading failures in this network              
-            
-        # Save Results (here the consumer areas)
-        #component_state_idp.append(i_component_state_casc)
-        i_affected_areas=ns.set_state_consumers(ExposureConsumerAreas,NetG)
-        affected_areas.append(i_affected_areas)
+    # Save Results (here the consumer areas)
+    return ns.set_state_consumers(ExposureConsumerAreas,Graph,consumers)
+
+'''FAST PATH
+returns the affected areas of the undamaged network (baseline), and the masks of the inert nodes and lines, whose failures
+cannot affect any consumer: the parts of the network that are connected to the sources and consumers only through bridges
+(found by pruning the tree of the 2-edge-connected components), except the nodes and lines adjacent to the nodes of the consumer areas.
+The failure of inert components does not change any shortest path between sources and consumers, hence the loads stay
+below the capacities and the cascading effects stop at once; this only holds if the loads are evaluated with all the source and
+terminal nodes (otherwise they depend on the random stream, and no component is inert).
+Returns None if the network is already damaged'''
+def fast_path_data(Graph,s_nodes0,t_nodes0,ExposureConsumerAreas):
+    if max(np.max(Graph.node_dam,initial=0.0),np.max(Graph.edge_dam,initial=0.0))>cons.MIN_DAMAGE:
+        return None
+    initial_state=Graph.copy_state()
+    consumers=ns.consumer_incidence(ExposureConsumerAreas,Graph)
+    baseline_areas=simulate_sample(Graph,s_nodes0,t_nodes0,ExposureConsumerAreas,initial_state,np.zeros(Graph.n_nodes,dtype=bool),
+                                   consumers=consumers)
+    Graph.restore_state(initial_state)
+    area_nodes=np.zeros(Graph.n_nodes,dtype=bool)
+    area_nodes[consumers[0]]=True
+    inert_nodes=np.zeros(Graph.n_nodes,dtype=bool)
+    if ns.loads_are_exact(Graph,s_nodes0,t_nodes0):
+        terminals=area_nodes|Graph.consumer_mask
+        terminals[list(s_nodes0)+list(t_nodes0)]=True
+        inert_nodes=_pruned_nodes(Graph,terminals)
+        # the state of an area depends on the damage of the lines of its node
+        near_areas=area_nodes.copy()
+        near_areas[Graph.edge_from[area_nodes[Graph.edge_to]]]=True
+        near_areas[Graph.edge_to[area_nodes[Graph.edge_from]]]=True
+        inert_nodes&=~near_areas
+    inert_edges=(inert_nodes[Graph.edge_from]|inert_nodes[Graph.edge_to])&~(area_nodes[Graph.edge_from]|area_nodes[Graph.edge_to])
+    return baseline_areas,inert_nodes,inert_edges
+
+'''nodes of the 2-edge-connected components that are not on the tree of bridges between the components with terminal nodes'''
+def _pruned_nodes(Graph,terminals):
+    bridges=Graph.bridges()
+    labels=Graph.component_labels(~bridges)
+    n_labels=np.max(labels,initial=-1)+1
+    marked=np.zeros(n_labels,dtype=bool)
+    marked[labels[terminals]]=True
+    # tree of the components, one edge per bridge
+    tree_from=labels[Graph.edge_from[bridges]]
+    tree_to=labels[Graph.edge_to[bridges]]
+    pruned=np.zeros(n_labels,dtype=bool)
+    while True:
+        alive=~pruned[tree_from]&~pruned[tree_to]
+        degree=np.bincount(tree_from[alive],minlength=n_labels)+np.bincount(tree_to[alive],minlength=n_labels)
+        leaves=~pruned&~marked&(degree<=1)
+        if not np.any(leaves):
+            break
+        pruned|=leaves
+    return pruned[labels]
+
+def _collect_samples(chunk,chunk_samples,stats):
+    chunk_areas,chunk_weights=chunk_samples
+    stats.add(chunk,chunk_areas,chunk_weights)
+    for i in chunk:
         print("MCS iteration: "+str(i))
-                     
-    return affected_areas
 
+'''Pool of worker processes for run_Monte_Carlo_simulation: the network and the data of the samples are sent once to each worker,
+not with every chunk of samples (nor with every batch, if the pool is reused); each worker uses a copy of the cache'''
+def make_worker_pool(workers,Graph,s_nodes0,t_nodes0,ExposureConsumerAreas,uniforms=None,line_fragility=False,sampling_pof=None,cache=None,
+                     baseline=None):
+    return multiprocessing.Pool(workers,initializer=_init_worker,
+                                initargs=(Graph,s_nodes0,t_nodes0,ExposureConsumerAreas,uniforms,line_fragility,sampling_pof,cache,baseline))
+
+# network data of the worker processes, set once by the pool initializer
+_worker_data=None
+
+def _init_worker(Graph,s_nodes0,t_nodes0,ExposureConsumerAreas,uniforms=None,line_fragility=False,sampling_pof=None,cache=None,baseline=None):
+    global _worker_data
+    _worker_data=(Graph,s_nodes0,t_nodes0,ExposureConsumerAreas,uniforms,line_fragility,sampling_pof,cache,baseline)
 
-#Post Processing: transform damaged areas into affected population
-def compute_output(SampleDamageAreas,ExposureConsumerAreas,nmcs):
-    SampleDamageNetwork=[int(np.sum([SampleDamageAreas[i][i_area]*ExposureConsumerAreas[cons.FEATURES][i_area][cons.PROPERTIES][cons.AREA_POPULATION]
-    for i_area in range(0,len(SampleDamageAreas[0]))])) for i in range(0,nmcs)]
+# returns the affected areas and the likelihood ratios of the samples, and the hits and misses of the cache of the worker in this chunk
+# with its current entries and bytes (by process id)
+def _simulate_chunk(args):
+    sample_ids,seed_sequence=args
+    Graph,s_nodes0,t_nodes0,ExposureConsumerAreas,uniforms,line_fragility,sampling_pof,cache,baseline=_worker_data
+    hits,misses=(cache.hits,cache.misses) if cache is not None else (0,0)
+    affected_areas,weights=simulate_samples(Graph,s_nodes0,t_nodes0,ExposureConsumerAreas,sample_ids,seed_sequence,uniforms,line_fragility,
+                                            sampling_pof,cache,baseline)
+    cache_stats={'hits':0,'misses':0,'entries':0,'bytes':0,'worker':os.getpid()}
+    if cache is not None:
+        cache_stats.update(cache.stats())
+        cache_stats['hits'],cache_stats['misses']=cache.hits-hits,cache.misses-misses
+    return affected_areas,weights,cache_stats
+
+
+#Post Processing: disruption probabilities of the areas, from the statistics of the samples (Netstats.SampleStatistics)
+#with the likelihood ratios of importance sampling (weighted statistics), the disruption probabilities are the weighted means of the samples,
+#with normal confidence intervals
+def compute_output(stats,ExposureConsumerAreas):
+    prob=stats.prob()
+    if stats.weighted:
+        se_prob=stats.se_prob()
+        for i_area,fea in enumerate(ExposureConsumerAreas[cons.FEATURES]):
+            est_apof=prob[i_area]
+            half_width=cons.Z_95*se_prob[i_area]
+            fea[cons.PROPERTIES][cons.AREA_POF]=est_apof
+            fea[cons.PROPERTIES][cons.AREA_POF_CI_LOW]=max(0.0,est_apof-half_width)
+            fea[cons.PROPERTIES][cons.AREA_POF_CI_HIGH]=min(1.0,est_apof+half_width)
+        return ExposureConsumerAreas
     for i_area in range(0,len(ExposureConsumerAreas[cons.FEATURES])):
-        est_apof=np.mean([SampleDamageAreas[i][i_area]for i in range(0,nmcs)])
+        est_apof=prob[i_area]
+        ci_low,ci_high=binomial_confidence_interval(est_apof,stats.n)
         ExposureConsumerAreas[cons.FEATURES][i_area][cons.PROPERTIES][cons.AREA_POF]=est_apof
-    return ExposureConsumerAreas,SampleDamageNetwork
\ No newline at end of file
+        ExposureConsumerAreas[cons.FEATURES][i_area][cons.PROPERTIES][cons.AREA_POF_CI_LOW]=ci_low
+        ExposureConsumerAreas[cons.FEATURES][i_area][cons.PROPERTIES][cons.AREA_POF_CI_HIGH]=ci_high
+    return ExposureConsumerAreas
+
+'''population of each consumer area'''
+def area_population(ExposureConsumerAreas):
+    return np.array([fea[cons.PROPERTIES][cons.AREA_POPULATION] for fea in ExposureConsumerAreas[cons.FEATURES]])
+
+'''Wilson score interval (95%) of a probability estimated as the mean of n Bernoulli samples.
+Unlike the normal approximation, it does not collapse to a point when no (or only) disruptions are observed'''
+def binomial_confidence_interval(p,n,z=cons.Z_95):
+    center=(p+z**2/(2*n))/(1+z**2/n)
+    half_width=z*np.sqrt(p*(1-p)/n+z**2/(4*n**2))/(1+z**2/n)
+    # exact bounds at the ends (avoid rounding errors)
+    ci_low=0.0 if p<=0 else max(0.0,center-half_width)
+    ci_high=1.0 if p>=1 else min(1.0,center+half_width)
+    return ci_low,ci_high
\ No newline at end of file
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+'''
+Long-lived server for the analysis of run_analysis.py and its client.
+
+The server runs the analysis for jobs received over HTTP on a
+local port. It keeps the imported modules, the exposure data, the
+fragility providers and the networks (with their initial loads and
+capacities) in memory between the jobs, so that a job only costs the
+reading of the intensity files and the simulation.
+
+The client sends the arguments of run_analysis.py to the server.
+It only uses the standard library, so that it starts fast.
+If there is no server, it exits with the code EXIT_NO_SERVER and the
+caller (the javaPS wrappers) runs run_analysis.py directly.
+
+Server:
+    python3 analysis_server.py --port 8765
+Client:
+    python3 analysis_server.py --client --port 8765 -- \
+        --country ecuador --hazard earthquake \
+        --intensity_file testinputs/shakemap.xml --output_file output.json
+'''
+
+import argparse
+import http.client
+import http.server
+import json
+import os
+import sys
+import time
+import traceback
+import urllib.error
+import urllib.request
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+# exit code of the client if there is no server
+EXIT_NO_SERVER = 3
+# timeout (s) of the client for checking that there is a server
+STATUS_TIMEOUT = 2.0
+
+
+class JobError(Exception):
+    '''
+    Exception for jobs with invalid arguments.
+    '''
+
+
+class AnalysisRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Handler for the requests to the analysis server:
+        GET /status: number of jobs and of stored objects
+        POST /run: runs a job, given as json with the arguments of
+        run_analysis.py ('args') and the working directory of the
+        client ('cwd', for relative file names). Returns a json with
+        the output file and the duration (s) of each stage.
+    '''
+
+    def do_GET(self):
+        if self.path != '/status':
+            self._send_json(404, {'status': 'error', 'message': 'Not found'})
+            return
+        self._send_json(200, {
+            'status': 'ok',
+            'jobs': self.server.jobs,
+            'stored': len(self.server.store)})
+
+    def do_POST(self):
+        if self.path != '/run':
+            self._send_json(404, {'status': 'error', 'message': 'Not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = json.loads(self.rfile.read(length).decode('utf8'))
+            result = self.server.run_job(job['args'], job.get('cwd'))
+        except (JobError, KeyError, ValueError) as e:
+            self._send_json(400, {'status': 'error', 'message': str(e)})
+            return
+        except Exception as e:
+            # the traceback goes to the log of the server
+            traceback.print_exc()
+            self._send_json(500, {
+                'status': 'error',
+                'message': '{0}: {1}'.format(type(e).__name__, e)})
+            return
+        self._send_json(200, result)
+
+    def _send_json(self, code, data):
+        body = json.dumps(data).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class AnalysisServer(http.server.HTTPServer):
+    '''
+    HTTP server that runs the jobs one after the other
+    (the stored networks are modified during a simulation).
+    '''
+
+    def __init__(self, address):
+        super().__init__(address, AnalysisRequestHandler)
+        # imported once, for all the jobs
+        import run_analysis
+        self._run_analysis = run_analysis
+        self.store = {}
+        self.jobs = 0
+
+    def run_job(self, args, cwd=None):
+        '''
+        Runs the analysis with the given arguments of run_analysis.py.
+        Relative intensity files, cache folders, common random
+        number files, raw sample and statistics files are taken relative
+        to cwd (the output file is relative to the folder of
+        run_analysis.py, as in the command line).
+        Returns a dict with the output file and the timings.
+        '''
+        start_time = time.time()
+        try:
+            parsed_args = self._run_analysis.make_argument_parser().parse_args(args)
+        except SystemExit:
+            raise JobError('Invalid arguments: ' + ' '.join(args))
+        if cwd is not None:
+            if parsed_args.intensity_file:
+                parsed_args.intensity_file = [
+                    os.path.join(cwd, x) for x in parsed_args.intensity_file]
+            if parsed_args.cache_dir is not None:
+                parsed_args.cache_dir = os.path.join(cwd, parsed_args.cache_dir)
+            if parsed_args.crn_file is not None:
+                parsed_args.crn_file = os.path.join(cwd, parsed_args.crn_file)
+            if parsed_args.raw_samples is not None:
+                parsed_args.raw_samples = os.path.join(cwd, parsed_args.raw_samples)
+            if parsed_args.stats_file is not None:
+                parsed_args.stats_file = os.path.join(cwd, parsed_args.stats_file)
+
+        timings = {}
+        output_file = self._run_analysis.run_scenario(
+            parsed_args, store=self.store, timings=timings)
+        self.jobs += 1
+        timings['job'] = time.time() - start_time
+        print('Job {0}: {1} {2}'.format(
+            self.jobs, output_file, json.dumps(timings, sort_keys=True)))
+        sys.stdout.flush()
+        return {'status': 'ok', 'output_file': output_file, 'timings': timings}
+
+
+def run_server(host, port):
+    '''
+    Runs the server until it is interrupted.
+    '''
+    server = AnalysisServer((host, port))
+    print('Analysis server listening on {0}:{1}'.format(host, port))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def run_client(host, port, analysis_args):
+    '''
+    Sends the job to the server and prints the timings.
+    Returns the exit code: 0 on success, EXIT_NO_SERVER if there is
+    no server (or the connection to it fails during the job, e.g. if
+    the server dies) and 1 if the job failed.
+    '''
+    url = 'http://{0}:{1}'.format(host, port)
+    # a local server, never through a proxy
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+    # the job itself may take long, hence there is no timeout for it,
+    # but a missing server is detected fast
+    try:
+        with opener.open(url + '/status', timeout=STATUS_TIMEOUT) as response:
+            response.read()
+    except (urllib.error.URLError, OSError) as e:
+        print('No analysis server at {0}: {1}'.format(url, e), file=sys.stderr)
+        return EXIT_NO_SERVER
+
+    request = urllib.request.Request(
+        url + '/run',
+        data=json.dumps({'args': analysis_args, 'cwd': os.getcwd()}).encode('utf8'),
+        headers={'Content-Type': 'application/json'})
+    try:
+        with opener.open(request) as response:
+            result = json.loads(response.read().decode('utf8'))
+    except urllib.error.HTTPError as e:
+        result = json.loads(e.read().decode('utf8'))
+        print('Analysis failed: ' + result.get('message', ''), file=sys.stderr)
+        return 1
+    except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+        # the caller runs the analysis itself, as without server
+        print('Connection to the analysis server at {0} failed: {1}'.format(url, e), file=sys.stderr)
+        return EXIT_NO_SERVER
+
+    print('Output file: ' + result['output_file'])
+    for stage, duration in sorted(result['timings'].items()):
+        print('{0}: {1:.3f} s'.format(stage, duration))
+    return 0
+
+
+def main():
+    # the arguments after -- are the ones of run_analysis.py
+    argv = sys.argv[1:]
+    analysis_args = []
+    if '--' in argv:
+        analysis_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    argparser = argparse.ArgumentParser(
+        description='Server for the analysis of run_analysis.py, or client of it (with --client)')
+    argparser.add_argument(
+        '--client', action='store_true',
+        help='Send the arguments after -- to the server. Exit code {0} if there is no server'.format(EXIT_NO_SERVER))
+    argparser.add_argument(
+        '--host', default=DEFAULT_HOST,
+        help='Host of the server. Default: {0}'.format(DEFAULT_HOST))
+    argparser.add_argument(
+        '--port', type=int, default=DEFAULT_PORT,
+        help='Port of the server. Default: {0}'.format(DEFAULT_PORT))
+    args = argparser.parse_args(argv)
+
+    if args.client:
+        sys.exit(run_client(args.host, args.port, analysis_args))
+    run_server(args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
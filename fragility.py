@@ -9,7 +9,7 @@ import collections
 import json
 import re
 
-from scipy.stats import lognorm
+from scipy.special import ndtr
 import numpy as np
 
 
@@ -18,9 +18,25 @@ class LogncdfFactory():
     This is function factory for the log normal cdf.
     '''
 
+    @staticmethod
+    def evaluate(values, mean, stddev):
+        '''
+        Evaluates the log normal cdf (mean and stddev are the
+        ones of the logarithm) elementwise, with the standard
+        normal cdf of the log values.
+        All the arguments can be arrays; values <= 0
+        have the probability 0.
+        '''
+        values = np.asarray(values, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = (np.log(values) - mean) / stddev
+        return np.where(values > 0, ndtr(z), 0.0)
+
     def __call__(self, mean, stddev):
-        func = lognorm(scale=np.exp(mean), s=stddev)
-        return func.cdf
+        def func(values):
+            # a scalar for scalar values
+            return self.evaluate(values, mean, stddev)[()]
+        return func
 
 
 SUPPORTED_FRAGILITY_FUNCTION_FACTORIES = {
@@ -38,7 +54,9 @@ class DamageState():
                  to_state,
                  intensity_field,
                  intensity_unit,
-                 fragility_function):
+                 fragility_function,
+                 mean=None,
+                 stddev=None):
         self.taxonomy = taxonomy
         self.from_state = from_state
         self.to_state = to_state
@@ -46,6 +64,9 @@ class DamageState():
         self.intensity_unit = intensity_unit
 
         self.fragility_function = fragility_function
+        # parameters of the fragility function
+        self.mean = mean
+        self.stddev = stddev
 
     def get_probability_for_intensity(self, intensity, units):
         '''
@@ -98,13 +119,21 @@ class Fragility():
         provider for the supported taxonomies
         and the damage states (with the fragility functions)
         are returned.
+
+        The shape of the fragility functions is the one of
+        the meta data, unless a dataset gives its own.
+        The vectorized evaluation of the provider needs the
+        same shape for all the damage states, so a ValueError
+        is raised if they differ.
         '''
         damage_states_by_taxonomy = collections.defaultdict(list)
 
-        shape = self._data['meta']['shape']
+        default_shape = self._data['meta']['shape']
+        shapes = set()
 
         for dataset in self._data['data']:
             taxonomy = dataset['taxonomy']
+            shape = dataset.get('shape', default_shape)
             intensity_field = dataset['imt']
             intensity_unit = dataset['imu']
             for damage_state_mean_key in [
@@ -146,23 +175,54 @@ class Fragility():
                     intensity_field=intensity_field,
                     intensity_unit=intensity_unit,
                     fragility_function=SUPPORTED_FRAGILITY_FUNCTION_FACTORIES[
-                        shape](mean, stddev)
+                        shape](mean, stddev),
+                    mean=mean,
+                    stddev=stddev
                 )
 
                 damage_states_by_taxonomy[taxonomy].append(damage_state)
+                shapes.add(shape)
+
+        if len(shapes) > 1:
+            raise ValueError(
+                'Fragility functions with different shapes: ' +
+                ', '.join(sorted(shapes)))
+        common_shape = shapes.pop() if shapes else default_shape
 
         schema = self._data['meta']['id']
 
-        return FragilityProvider(damage_states_by_taxonomy, schema)
+        return FragilityProvider(
+            damage_states_by_taxonomy, schema, common_shape)
 
 class FragilityProvider():
     '''
     Class to give access to the taxonomies and
     the damage states with the fragility functions.
+
+    For the vectorized evaluation there is a parameter
+    table with the mean, stddev, intensity field and unit
+    of the first damage state of each taxonomy
+    (there is just one damage state for each taxonomy
+    in the current data).
     '''
-    def __init__(self, damage_states_by_taxonomy, schema):
+    def __init__(self, damage_states_by_taxonomy, schema, shape='logncdf'):
         self._damage_states_by_taxonomy = damage_states_by_taxonomy
         self._schema = schema
+        self._fragility_function_factory = SUPPORTED_FRAGILITY_FUNCTION_FACTORIES[shape]
+
+        taxonomies = [
+            taxonomy for taxonomy, damage_states
+            in damage_states_by_taxonomy.items() if damage_states]
+        first_damage_states = [
+            damage_states_by_taxonomy[taxonomy][0] for taxonomy in taxonomies]
+        self._taxonomy_index = {
+            taxonomy: i for i, taxonomy in enumerate(taxonomies)}
+        self._mean = np.array(
+            [x.mean for x in first_damage_states], dtype=float)
+        self._stddev = np.array(
+            [x.stddev for x in first_damage_states], dtype=float)
+        self._fields = [x.intensity_field.upper() for x in first_damage_states]
+        self._units = [x.intensity_unit for x in first_damage_states]
 
     def get_damage_states_for_taxonomy(self, taxonomy):
         '''
@@ -179,3 +239,40 @@ class FragilityProvider():
 
     def get_schema(self):
         return self._schema
+
+    def get_taxonomy_indices(self, taxonomies):
+        '''
+        Returns the indices in the parameter table
+        of the given taxonomies, as an array.
+        Raises a KeyError for taxonomies without damage states.
+        '''
+        return np.array(
+            [self._taxonomy_index[taxonomy] for taxonomy in taxonomies],
+            dtype=np.intp)
+
+    def get_probabilities(self, taxonomy_indices, intensity, units):
+        '''
+        Returns the probabilities of the first damage state
+        for all the elements with the given taxonomy indices
+        (see get_taxonomy_indices) in one vectorized call.
+
+        The intensity and units are given as dicts with one
+        array per field, as returned by get_nearest_batch of the
+        intensity providers (the taxonomies may use different fields).
+
+        This method throws an exception if the unit for the
+        fragility function is not the expected one.
+        '''
+        taxonomy_indices = np.asarray(taxonomy_indices, dtype=np.intp)
+        values = np.zeros(len(taxonomy_indices))
+        for i in np.unique(taxonomy_indices):
+            field = self._fields[i]
+            if units[field] != self._units[i]:
+                raise Exception('Not supported unit')
+            selected = taxonomy_indices == i
+            values[selected] = np.asarray(intensity[field])[selected]
+
+        return self._fragility_function_factory.evaluate(
+            values,
+            self._mean[taxonomy_indices],
+            self._stddev[taxonomy_indices])
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark of the startup (import) time of run_analysis.py.
+
+run_analysis is imported in fresh interpreters, so that nothing is
+already loaded, and the best and the median time are reported.
+The benchmark fails (exit code 1) if one of the modules that are
+only imported when they are used (DEFERRED_MODULES) is imported at
+startup, or if the best time exceeds --max_time.
+
+    python3 import_benchmark.py --repeat 5 --max_time 1.0
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# modules that must not be imported by run_analysis at startup
+DEFERRED_MODULES = (
+    'matplotlib',
+    'shapely',
+    'scipy.stats',
+    'scipy.spatial',
+)
+
+CHILD_CODE = '''
+import json, sys, time
+start_time = time.time()
+import run_analysis
+duration = time.time() - start_time
+print(json.dumps({'time': duration, 'modules': sorted(sys.modules)}))
+'''
+
+
+def measure_import(module_dir):
+    '''
+    Imports run_analysis in a new interpreter.
+    Returns the import time and the names of the imported modules.
+    '''
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHILD_CODE], cwd=module_dir)
+    result = json.loads(output.decode('utf8').strip().splitlines()[-1])
+    return result['time'], result['modules']
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description='Benchmark of the import time of run_analysis.py')
+    argparser.add_argument(
+        '--repeat', type=int, default=5,
+        help='Number of measurements. Default: 5')
+    argparser.add_argument(
+        '--max_time', type=float,
+        help='Maximal accepted import time (best of the measurements) in seconds')
+    args = argparser.parse_args()
+
+    module_dir = os.path.dirname(os.path.realpath(__file__))
+    times = []
+    modules = []
+    for _ in range(args.repeat):
+        duration, modules = measure_import(module_dir)
+        times.append(duration)
+    times.sort()
+
+    print('import run_analysis: best {0:.3f} s, median {1:.3f} s ({2} runs)'.format(
+        times[0], times[len(times) // 2], len(times)))
+
+    failed = False
+    imported = [
+        name for name in DEFERRED_MODULES
+        if any(x == name or x.startswith(name + '.') for x in modules)]
+    if imported:
+        print('Imported at startup: ' + ', '.join(imported))
+        failed = True
+    if args.max_time is not None and times[0] > args.max_time:
+        print('The import time exceeds {0:.3f} s'.format(args.max_time))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
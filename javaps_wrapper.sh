@@ -27,4 +27,25 @@ fi
 
 echo "(combined) INPUT_INTENSITY=$INPUT_INTENSITY"
 
-python3 ./run_analysis.py --country $INPUT_COUNTRY --hazard $INPUT_HAZARD --intensity_file $INPUT_INTENSITY --output_file $OUTPUT_DAMAGE_CONSUMER_AREAS
\ No newline at end of file
+# optional settings of the simulation (not WPS inputs)
+# ANALYSIS_WORKERS: number of worker processes, ANALYSIS_SEED: master seed
+ANALYSIS_OPTIONS=""
+if [[ -n "${ANALYSIS_WORKERS}" ]]; then
+    ANALYSIS_OPTIONS="$ANALYSIS_OPTIONS --workers $ANALYSIS_WORKERS"
+fi
+if [[ -n "${ANALYSIS_SEED}" ]]; then
+    ANALYSIS_OPTIONS="$ANALYSIS_OPTIONS --seed $ANALYSIS_SEED"
+fi
+echo "ANALYSIS_OPTIONS=$ANALYSIS_OPTIONS"
+
+ANALYSIS_ARGS="--country $INPUT_COUNTRY --hazard $INPUT_HAZARD --intensity_file $INPUT_INTENSITY --output_file $OUTPUT_DAMAGE_CONSUMER_AREAS $ANALYSIS_OPTIONS"
+
+# the analysis runs in the analysis server (analysis_server.py) if there is one at ANALYSIS_SERVER_PORT (default 8765),
+# which keeps the networks in memory; without a server (exit code 3 of the client) it runs directly
+python3 ./analysis_server.py --client --port "${ANALYSIS_SERVER_PORT:-8765}" -- $ANALYSIS_ARGS
+status=$?
+if [[ $status -eq 3 ]]; then
+    python3 ./run_analysis.py $ANALYSIS_ARGS
+    status=$?
+fi
+exit $status
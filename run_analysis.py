@@ -18,41 +18,206 @@ Created on Wed Aug 14 11:15:58 2019
 """
 
 import argparse
+import csv
+import glob
+import hashlib
 import json
+import multiprocessing
 import os
+import time
 
-import shapely.geometry
+# matplotlib and shapely are imported in the functions that use them (they are rarely needed and slow to import)
 import numpy as np
-import matplotlib.pyplot as plt
 
 import shakemap
 import fragility
+import Constants as cons
+import Netcache
+import Netexposure
+import Netstats
 import Sysrel as sr
 
-def run_network_simulation(DamageNodes, ExposureLines, NetworkFragility, ExposureConsumerAreas):
+ALPHA=1.5#safety factor (>=1.0) for estimating capacity based on initial loads 
+IS_TARGET_FAILURES=1.0#expected number of failed uncertain components per sample with importance sampling
+CASCADE_CACHE_MB=64.0#memory bound (MB) of the cache of the failure sets
+OUTPUT_EXTENSIONS={'geojson':'.geojson','json':'.json','csv':'.csv'}#output formats of the consumer areas and their file extensions
+
+# MAIN FUNCTION
+# returns the consumer areas with their disruption probabilities and the statistics of the samples (Netstats.SampleStatistics)
+# with adaptive=True, nmcs is the maximal number of samples, simulated in batches of batch_size until the standard errors
+# are below tol_prob (disruption probabilities) and tol_population (affected population, relative), or max_time (s) is exceeded
+# with a network_cache file, the network with its initial loads and capacities is loaded from it (or saved in it, in the first run);
+# ExposureLines can also be the name of the geojson file, which is then only read if the network is not in the cache (see read_line_exposure)
+# store: optional dict in which the networks are kept in memory (see get_stored); timings: optional dict, filled with the duration (s) of the stages
+# with crn=True, the node failures of the direct hazard action come from a matrix of common random numbers (see get_common_random_numbers),
+# so that scenarios with the same seed (or crn_file) are compared with the same random failures
+# with line_fragility=True, the lines fail with the probabilities of failure of the line exposure (property ProbFailure) too
+# with importance_sampling=True, the small probabilities of failure are raised for sampling, such that is_target_failures components
+# fail per sample on average, and the samples are weighted by their likelihood ratios (for rare disruptions, see Sysrel.importance_sampling_pof);
+# raw_samples: optional .npy file in which the state of the areas of every sample is stored (memory-mapped, samples x areas, 0 ok and 1 blackout;
+# with adaptive, nmcs rows of which the first ones are simulated), with importance sampling also their weights (see Netstats.SampleStatistics.open_raw)
+# with cascade_cache=True, the affected areas of each failure set of the direct hazard action are cached (see Netcache), with at most
+# cascade_cache_entries entries and cascade_cache_mb MB; the samples with a cached failure set skip the cascading effects
+# od_sampling: source and consumer nodes of the loads, initial and in the cascading effects (cons.OD_RANDOM, OD_EXACT or OD_FIXED, see Netsim.od_nodes);
+# the network_cache file must be the one of this od_sampling (see network_cache_file); without seed and with OD_RANDOM, the initial loads
+# are random in every run, hence the network is neither loaded from the cache nor saved in it (the file only gives the folder of the sidecar)
+def run_network_simulation(DamageNodes, ExposureLines, NetworkFragility, ExposureConsumerAreas, seed=None, workers=1,
+                           nmcs=50, adaptive=False, batch_size=50, tol_prob=0.01, tol_population=0.05, max_time=None,
+                           alpha=ALPHA, network_cache=None, store=None, timings=None, crn=False, crn_file=None, line_fragility=False,
+                           importance_sampling=False, is_target_failures=IS_TARGET_FAILURES, raw_samples=None,
+                           cascade_cache=False, cascade_cache_entries=None, cascade_cache_mb=CASCADE_CACHE_MB, od_sampling=cons.OD_RANDOM):
+    timings=timings if timings is not None else {}
+    start_time=time.time()
+    # independent random streams for the initial loads, for the samples and for the common random numbers
+    setup_seed,mcs_seed,crn_seed=np.random.SeedSequence(seed).spawn(3)
     ##### ----------------------------- Load network data -------------------------------########
-    Graph,source_nodes,consumer_nodes=sr.load_network_data(DamageNodes,ExposureLines,NetworkFragility)
-    ##### --------------------- Assess unperturbed system and capacities ----------------########
-    sr.evaluate_system_loads(Graph,source_nodes,consumer_nodes)
-    alpha=1.5#safety factor (>=1.0) for estimating capacity based on initial loads 
-    sr.assign_initial_capacities(Graph,alpha)
+    Graph=None
+    network_key=('network',network_cache)
+    reuse_network=network_cache is not None and (seed is not None or od_sampling!=cons.OD_RANDOM)
+    if reuse_network and store is not None and network_key in store:
+        Graph,source_nodes,consumer_nodes=store[network_key]
+        sr.assign_node_pof(Graph,DamageNodes)
+    elif reuse_network and os.path.exists(network_cache):
+        try:
+            Graph,source_nodes,consumer_nodes=sr.load_saved_network_data(network_cache,DamageNodes)
+        except Exception as e:
+            print('Network cache '+network_cache+' not used: '+str(e))
+    if Graph is None:
+        if isinstance(ExposureLines,str):
+            ExposureLines=get_stored(store,'lines',ExposureLines,lambda filename: read_line_exposure(filename,network_cache))
+        Graph,source_nodes,consumer_nodes=sr.load_network_data(DamageNodes,ExposureLines,NetworkFragility)
+        Graph.od_sampling=od_sampling
+        ##### --------------------- Assess unperturbed system and capacities ----------------########
+        sr.evaluate_system_loads(Graph,source_nodes,consumer_nodes,seed=setup_seed)
+        sr.assign_initial_capacities(Graph,alpha)
+        if reuse_network:
+            save_network_cache(network_cache,Graph,source_nodes,consumer_nodes)
+    if store is not None and reuse_network:
+        store[network_key]=(Graph,source_nodes,consumer_nodes)
+    Graph.od_sampling=od_sampling
+    timings['network']=time.time()-start_time
     ##### ----------------------------- Monte Carlo Simulation --------------------------########
-    nmcs=50 #number of samples
+    start_time=time.time()
+    uniforms=None
+    if crn or crn_file is not None:
+        uniforms=get_common_random_numbers(Graph,nmcs,crn_seed,crn_file)
+    sampling_pof=None
+    if importance_sampling:
+        sampling_pof=sr.importance_sampling_pof(Graph,is_target_failures,line_fragility)
+    # statistics of the samples, updated as they are simulated
+    raw,raw_weights=None,None
+    if raw_samples is not None:
+        raw,raw_weights=Netstats.SampleStatistics.open_raw(raw_samples,nmcs,len(ExposureConsumerAreas[cons.FEATURES]),importance_sampling)
+    SampleStats=Netstats.SampleStatistics(sr.area_population(ExposureConsumerAreas),weighted=importance_sampling,raw=raw,raw_weights=raw_weights)
+    # the cache is specific to this network, probabilities of failure and seed
+    cache=None
+    if cascade_cache:
+        cache=Netcache.FailureSetCache(cascade_cache_entries,int(cascade_cache_mb*1024*1024))
     # obtain samples of affected areas
-    SampleAreas=sr.run_Monte_Carlo_simulation(Graph,source_nodes,consumer_nodes,ExposureConsumerAreas,nmcs)
+    if adaptive:
+        sr.run_adaptive_Monte_Carlo_simulation(Graph,source_nodes,consumer_nodes,ExposureConsumerAreas,batch_size,nmcs,
+                                               tol_prob,tol_population,max_time=max_time,seed=mcs_seed,workers=workers,
+                                               uniforms=uniforms,line_fragility=line_fragility,sampling_pof=sampling_pof,
+                                               stats=SampleStats,cache=cache)
+    else:
+        sr.run_Monte_Carlo_simulation(Graph,source_nodes,consumer_nodes,ExposureConsumerAreas,nmcs,seed=mcs_seed,workers=workers,
+                                      uniforms=uniforms,line_fragility=line_fragility,sampling_pof=sampling_pof,stats=SampleStats,
+                                      cache=cache)
+    if raw is not None:
+        raw.flush()
+        if raw_weights is not None:
+            raw_weights.flush()
+    timings['monte_carlo']=time.time()-start_time
+    if cache is not None:
+        print('Cascade cache: {hits} hits, {misses} misses, {entries} entries, {bytes} bytes'.format(**cache.stats()))
     ##### ----------------------------- Post Processing ---------------------------------########
-    DamageConsumerAreas,SampleDamageNetwork=sr.compute_output(SampleAreas,ExposureConsumerAreas,nmcs)
+    start_time=time.time()
+    DamageConsumerAreas=sr.compute_output(SampleStats,ExposureConsumerAreas)
+    timings['statistics']=time.time()-start_time
         
-    return DamageConsumerAreas,SampleDamageNetwork
+    return DamageConsumerAreas,SampleStats
+
+# COMMON RANDOM NUMBERS
+# loaded from crn_file if it exists, otherwise drawn from the seed (and saved in crn_file, if given)
+# a loaded matrix must have at least n_samples rows; the file is never overwritten, so that the samples can be reproduced
+def get_common_random_numbers(Graph,n_samples,seed=None,crn_file=None):
+    if crn_file is not None and os.path.exists(crn_file):
+        uniforms=sr.load_common_random_numbers(crn_file,Graph)
+        if len(uniforms)<n_samples:
+            raise ValueError('The common random numbers of '+crn_file+' have '+str(len(uniforms))+' samples, '+str(n_samples)+' are needed')
+        return uniforms
+    uniforms=sr.draw_common_random_numbers(Graph,n_samples,seed)
+    if crn_file is not None:
+        sr.save_common_random_numbers(crn_file,uniforms,Graph)
+    return uniforms
+
+# NETWORK CACHE
+# name of the cache file of a network: prefix_network_<hash>_<seed>.npz, with a hash of the contents of the exposure files, of the
+# source and terminal taxonomies of the network fragility (the only part of it that is used)
+# and of alpha (and of od_sampling, if it is not the default), hence a change of any of them leads to a new file. The initial loads depend on the
+# seed only with random OD sampling; with the other ones the file name has no seed, so that the network is cached once for all the seeds
+# (with random OD sampling and without seed, run_network_simulation does not use the file)
+def network_cache_file(cache_dir,prefix,exposure_files,NetworkFragility,alpha=ALPHA,seed=None,store=None,od_sampling=cons.OD_RANDOM):
+    key=hashlib.sha256()
+    for filename in exposure_files:
+        key.update(get_stored(store,'hash',filename,file_hash))
+    meta=NetworkFragility[cons.META]
+    hashed=[meta[cons.SOURCE],meta[cons.TERMINAL],alpha]
+    if od_sampling!=cons.OD_RANDOM:
+        hashed.append(od_sampling)
+        seed=None
+    key.update(json.dumps(hashed,sort_keys=True).encode('utf8'))
+    return os.path.join(cache_dir,prefix+'_network_'+key.hexdigest()[:20]+'_'+str(seed)+'.npz')
+
+def file_hash(filename):
+    with open(filename,'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+# saves the network in the cache file; only the most recently written max_files files of the same country are kept
+# (outdated files are never loaded again, as their names contain the hash of the former contents)
+def save_network_cache(network_cache,Graph,source_nodes,consumer_nodes,max_files=8):
+    cache_dir=os.path.dirname(network_cache)
+    if cache_dir:
+        os.makedirs(cache_dir,exist_ok=True)
+    sr.save_network_data(network_cache,Graph,source_nodes,consumer_nodes)
+    prefix=os.path.basename(network_cache).split('_network_')[0]
+    cache_files=sorted(glob.glob(os.path.join(cache_dir,prefix+'_network_*.npz')),key=os.path.getmtime,reverse=True)
+    for filename in cache_files[max_files:]:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass# removed by a concurrent run
+
+# IN-MEMORY STORE
+# the analysis server keeps imported files and objects built from them in a dict (store), by kind and file name;
+# an entry is rebuilt when the modification time or the size of the file changes. Without store, the object is just built
+def get_stored(store,kind,filename,build):
+    if store is None:
+        return build(filename)
+    stat=os.stat(filename)
+    version=(stat.st_mtime,stat.st_size)
+    key=(kind,os.path.abspath(filename))
+    if key not in store or store[key][0]!=version:
+        store[key]=(version,build(filename))
+    return store[key][1]
+
+def build_fragility_provider(fragility_file):
+    return fragility.Fragility.from_file(fragility_file).to_fragility_provider()
 
 # IMPORT JSON FILES AND CREATE DICTIONARY
+# byte order marks (and the weird char sequence that might appear instead of them) are removed from the bytes of the file
 def import_json_to_dict(filename):
-    data={}
-    with open(filename, encoding="utf8") as f:
-        s=f.read()
-        s = s.replace('ï»¿','')#for some reason, this weird char sequence might appear when opening
-        data=json.loads(s)
-    return data
+    with open(filename,'rb') as f:
+        return Netexposure.load_json(f.read())
+
+# IMPORT THE LINE EXPOSURE AS COLUMNS (see Netexposure)
+# with a network cache file, the columns are kept in a sidecar file in its folder (<name of the geojson file>.columns),
+# which is loaded memory-mapped by the next runs that build a network (e.g. with another seed) as long as the geojson file is the same
+def read_line_exposure(filename,network_cache=None):
+    sidecar=None
+    if network_cache is not None:
+        sidecar=os.path.join(os.path.dirname(network_cache),os.path.splitext(os.path.basename(filename))[0]+'.columns')
+    return Netexposure.ExposureColumns.read(filename,value_keys=sr.LINE_VALUES,lines=True,sidecar=sidecar)
 
 # SAVE ANALYSIS IN GEOJSON FILE
 # creates a geojson file with the information of the input geojson files (resp. CSV), plus the attributes created during the analysis (such as fragility parameters and damage level)
@@ -60,59 +225,140 @@ def save_to_JSON(DataOutDict,filename):
     with open(filename, 'w') as outfile:
         json.dump(DataOutDict, outfile)
 
-def make_histogram(SampleDamageNetwork):
-    # make a histogram with the output vector of total affected population
-    SampleDamageNetwork_1000=[SampleDamageNetwork[i]/1000 for i in range(0,len(SampleDamageNetwork))]
-    plt.hist(SampleDamageNetwork_1000,normed=True,stacked=True)
+# GEOJSON TEMPLATE
+# the serialized feature collection without the properties of the features: everything else (the geometries) never changes, hence it is
+# serialized once (and kept in the store of the analysis server) and save_to_geojson only serializes the properties
+def make_geojson_template(FeatureCollection):
+    head,tail=_serialize_around(FeatureCollection,cons.FEATURES)
+    features=[_serialize_around(feature,cons.PROPERTIES) for feature in FeatureCollection[cons.FEATURES]]
+    return {'head':head,'tail':tail,'features':features}
+
+# serialization of a dict (as json.dump) before and after the value of the key
+def _serialize_around(data,key):
+    placeholder=json.dumps('@@'+key+'@@')
+    parts=json.dumps(dict(data,**{key:'@@'+key+'@@'})).split(placeholder)
+    if len(parts)!=2:
+        raise ValueError('The json data contains the placeholder '+placeholder)
+    return parts[0],parts[1]
+
+# writes the same file as save_to_JSON, from the template of the same feature collection (see make_geojson_template)
+def save_to_geojson(DataOutDict,filename,template=None):
+    features=DataOutDict[cons.FEATURES]
+    if template is None or len(template['features'])!=len(features):
+        save_to_JSON(DataOutDict,filename)
+        return
+    parts=[template['head'],'[']
+    for i,(feature,(prefix,suffix)) in enumerate(zip(features,template['features'])):
+        parts+=[', ' if i>0 else '',prefix,json.dumps(feature[cons.PROPERTIES]),suffix]
+    parts+=[']',template['tail']]
+    with open(filename,'w') as outfile:
+        outfile.write(''.join(parts))
+
+# SAVE THE PROPERTIES OF THE AREAS
+# without geometries: a json file with the properties of each area by area name, or a csv file with one row per area
+def save_properties_to_JSON(DataOutDict,filename):
+    properties={feature[cons.PROPERTIES][cons.AREA_NAME]:feature[cons.PROPERTIES] for feature in DataOutDict[cons.FEATURES]}
+    with open(filename,'w') as outfile:
+        json.dump(properties,outfile)
+
+def save_properties_to_CSV(DataOutDict,filename):
+    fields=[]
+    for feature in DataOutDict[cons.FEATURES]:
+        fields+=[key for key in feature[cons.PROPERTIES] if key not in fields]
+    with open(filename,'w',newline='') as outfile:
+        writer=csv.DictWriter(outfile,fieldnames=fields)
+        writer.writeheader()
+        for feature in DataOutDict[cons.FEATURES]:
+            writer.writerow(feature[cons.PROPERTIES])
+
+# SAVE THE CONSUMER AREAS in the output format (see OUTPUT_EXTENSIONS); template: optional geojson template of the areas
+def save_output(DataOutDict,filename,output_format='geojson',template=None):
+    if output_format=='geojson':
+        save_to_geojson(DataOutDict,filename,template)
+    elif output_format=='json':
+        save_properties_to_JSON(DataOutDict,filename)
+    elif output_format=='csv':
+        save_properties_to_CSV(DataOutDict,filename)
+    else:
+        raise ValueError('Not supported output format: '+str(output_format))
+
+# with a file name, or without display, the histogram is saved with the headless backend Agg (to histogram.png by default)
+# the histogram of the affected population is the one accumulated in the statistics of the samples (SampleStats)
+def make_histogram(SampleStats,filename=None):
+    import matplotlib
+    if filename is not None or not os.environ.get('DISPLAY'):
+        matplotlib.use('Agg')
+        if filename is None:
+            filename='histogram.png'
+    import matplotlib.pyplot as plt
+    # make a histogram with the bins of the total affected population
+    bin_edges_1000=SampleStats.bin_edges/1000
+    SampleStats.flush()
+    plt.hist(bin_edges_1000[:-1],bins=bin_edges_1000,density=True,stacked=True,weights=SampleStats.histogram)
     plt.xlabel('Affected population / Población afectada (thousands/miles)')
     plt.ylabel('Probability / Probabilidad')
     plt.title('Histogram of affected population / histograma de población afectada')
     plt.grid(True)
-    plt.show()
-    print('mean (thousands): '+str(np.mean(SampleDamageNetwork_1000))+" , Coeff. of Variation: "+str(np.std(SampleDamageNetwork_1000)/np.mean(SampleDamageNetwork_1000)))
+    if filename is not None:
+        plt.savefig(filename)
+    else:
+        plt.show()
+    mean,std=SampleStats.population_moments()
+    print('mean (thousands): '+str(mean/1000)+" , Coeff. of Variation: "+str(std/mean))
 
-def evaluate_ProbFailure_oneIntensity(fragility_file,im_file,Nodes):
+# LOCATIONS OF THE NODES
+# point geometries are used directly, other geometries by their centroid
+def get_node_locations(Nodes):
+    n_nodes=len(Nodes['features'])
+    lons=np.empty(n_nodes)
+    lats=np.empty(n_nodes)
+    for i,feature in enumerate(Nodes['features']):
+        geometry=feature['geometry']
+        if geometry['type']=='Point':
+            lons[i],lats[i]=geometry['coordinates'][:2]
+        else:
+            import shapely.geometry
+            centroid=shapely.geometry.shape(geometry).centroid
+            lons[i],lats[i]=centroid.x,centroid.y
+    return lons,lats
 
-    intensity_provider = shakemap.Shakemaps.from_file(im_file).to_intensity_provider()
-    fragility_provider = fragility.Fragility.from_file(fragility_file).to_fragility_provider()
+# PROBABILITY OF FAILURE OF THE NODES FOR ONE INTENSITY
+# the intensities at all nodes are looked up with one query of the intensity provider
+# and the fragility functions are evaluated in one vectorized call
+def compute_ProbFailure(fragility_file,im_file,Nodes,interpolation='nearest',store=None):
 
-    # add the fragility value for the element in the field "ProbFailure"
+    intensity_provider = shakemap.Shakemaps.from_file(im_file).to_intensity_provider(interpolation)
+    fragility_provider = get_stored(store,'fragility',fragility_file,build_fragility_provider)
+
+    lons,lats=get_node_locations(Nodes)
+    intensities,units,_=intensity_provider.get_nearest_batch(lons,lats)
+    # there is just one damage state for each taxonomy
+    taxonomy_indices=fragility_provider.get_taxonomy_indices([feature['properties']['taxonomy'] for feature in Nodes['features']])
+    pof=fragility_provider.get_probabilities(taxonomy_indices,intensities,units)
+    return pof
 
-    for feature in Nodes['features']:
-        centroid = shapely.geometry.shape(feature['geometry']).centroid
-        lon, lat = centroid.x, centroid.y
+def evaluate_ProbFailure_oneIntensity(fragility_file,im_file,Nodes,interpolation='nearest',store=None):
 
-        intensity, units = intensity_provider.get_nearest(lon=lon, lat=lat)
-        # there is just one damage state for each taxonomy
-        damage_state = fragility_provider.get_damage_states_for_taxonomy(feature['properties']['taxonomy'])[0]
-        p = damage_state.get_probability_for_intensity(intensity, units)
-        feature['properties']['ProbFailure'] = p
+    pof=compute_ProbFailure(fragility_file,im_file,Nodes,interpolation,store)
+    # add the fragility value for the element in the field "ProbFailure"
+    for feature,p in zip(Nodes['features'],pof):
+        feature['properties']['ProbFailure'] = float(p)
 
-def evaluate_ProbFailure_multiIntensity(fragility_file_list,im_file_list,Nodes):
+def evaluate_ProbFailure_multiIntensity(fragility_file_list,im_file_list,Nodes,interpolation='nearest',store=None):
     
-    #first intensity (lahars, height) for creating the field ProbFailure in Nodes
-    evaluate_ProbFailure_oneIntensity(fragility_file_list[0],im_file_list[0],Nodes)
-    # we assume that the fragility and intensity lists have the same order ( for lahars, second intensity and fragility is velocity)
+    # we assume that the fragility and intensity lists have the same order (for lahars, first height and then velocity)
+    # the probability of failure is the maximum over the intensities
+    pof=compute_ProbFailure(fragility_file_list[0],im_file_list[0],Nodes,interpolation,store)
     for i in range(1,len(fragility_file_list)):
-        intensity_provider = shakemap.Shakemaps.from_file(im_file_list[i]).to_intensity_provider()
-        fragility_provider = fragility.Fragility.from_file(fragility_file_list[i]).to_fragility_provider()
-        #print("Matched frag and haz")
-        # add the fragility value for the element in the field "ProbFailure"
-        for feature in Nodes['features']:
-            centroid = shapely.geometry.shape(feature['geometry']).centroid
-            lon, lat = centroid.x, centroid.y
-            intensity, units = intensity_provider.get_nearest(lon=lon, lat=lat)
-            # there is just one damage state for each taxonomy
-            damage_state = fragility_provider.get_damage_states_for_taxonomy(feature['properties']['taxonomy'])[0]
-            p = damage_state.get_probability_for_intensity(intensity, units)
-            q = feature['properties']['ProbFailure']
-            #print(feature['properties']['Name Node']+": ("+str(lon)+", "+str(lat)+"), "+" "+str(intensity)+" "+str(q)+" "+str(p))
-            feature['properties']['ProbFailure'] =max(p,q)
+        pof=np.maximum(pof,compute_ProbFailure(fragility_file_list[i],im_file_list[i],Nodes,interpolation,store))
+    # add the fragility value for the element in the field "ProbFailure"
+    for feature,p in zip(Nodes['features'],pof):
+        feature['properties']['ProbFailure'] = float(p)
 
     
-def main():
-    ##### ----------------------------- location of input files----------------------------------------########
-
+# ARGUMENTS OF THE ANALYSIS
+# (also used by the analysis server, which receives the same arguments as this script)
+def make_argument_parser():
     argparser = argparse.ArgumentParser(
         description='Script to compute the probability of disruption given a shakemap')
     argparser.add_argument(
@@ -127,8 +373,101 @@ def main():
     argparser.add_argument(
         '--output_file',
         help='Name of the output file for the consumer areas with damage.')
+    argparser.add_argument(
+        '--interpolation', choices=['nearest', 'bilinear'], default='nearest',
+        help='Interpolation of the intensities on regular grids. Default: nearest')
+    argparser.add_argument(
+        '--workers', type=int, default=1,
+        help='Number of worker processes for the Monte Carlo simulation. Default: 1')
+    argparser.add_argument(
+        '--seed', type=int,
+        help='Master seed of the random numbers. The results for a given seed do not depend on the number of workers')
+    argparser.add_argument(
+        '--nmcs', type=int, default=50,
+        help='Number of Monte Carlo samples (maximal number with --adaptive). Default: 50')
+    argparser.add_argument(
+        '--adaptive', action='store_true',
+        help='Simulate batches of samples until the standard errors are below the tolerances')
+    argparser.add_argument(
+        '--batch_size', type=int, default=50,
+        help='Number of samples per batch with --adaptive. Default: 50')
+    argparser.add_argument(
+        '--tol_prob', type=float, default=0.01,
+        help='Tolerance for the standard error of the disruption probability of each area with --adaptive '
+             '(from its 95%% confidence interval, also without observed disruptions). Default: 0.01')
+    argparser.add_argument(
+        '--tol_population', type=float, default=0.05,
+        help='Tolerance for the standard error of the mean affected population, relative to the mean, with --adaptive. Default: 0.05')
+    argparser.add_argument(
+        '--max_time', type=float,
+        help='Time budget in seconds for the samples with --adaptive')
+    argparser.add_argument(
+        '--cache_dir',
+        help='Folder for the cache of the networks with their initial loads and capacities. Default: network_cache next to this script')
+    argparser.add_argument(
+        '--no_cache', action='store_true',
+        help='Always build the network from the exposure files, without cache')
+    argparser.add_argument(
+        '--manifest',
+        help='Json file with a batch of scenarios (see read_manifest). The network is built once, the scenarios are distributed over '
+        'the --workers and the --output_file is the summary table (csv). Default summary: summary.csv in the --output_dir')
+    argparser.add_argument(
+        '--output_dir',
+        help='Folder of the outputs of the scenarios with --manifest. Default: folder of the manifest')
+    argparser.add_argument(
+        '--crn', action='store_true',
+        help='Common random numbers: the node failures come from one matrix of uniform numbers (samples x nodes) drawn from the seed, '
+        'so that scenarios and variants with the same --seed are compared with the same random failures')
+    argparser.add_argument(
+        '--crn_file',
+        help='File (.npz) of the common random numbers (implies --crn): loaded if it exists, otherwise drawn and saved in it. '
+        'The columns are matched to the nodes and lines by name; use one file per country')
+    argparser.add_argument(
+        '--line_fragility', action='store_true',
+        help='The lines fail with the probability of failure of the line exposure (property ProbFailure), besides the nodes')
+    argparser.add_argument(
+        '--importance_sampling', action='store_true',
+        help='Sample the failures with raised probabilities and weight the samples by their likelihood ratios, '
+        'for resolving small disruption probabilities with few samples')
+    argparser.add_argument(
+        '--is_target_failures', type=float, default=IS_TARGET_FAILURES,
+        help='Expected number of failed components per sample with --importance_sampling. Default: {0}'.format(IS_TARGET_FAILURES))
+    argparser.add_argument(
+        '--cascade_cache', action='store_true',
+        help='Cache the affected areas of each set of failed components, so that samples with the same failures skip the cascading effects')
+    argparser.add_argument(
+        '--cascade_cache_entries', type=int,
+        help='Maximal number of failure sets in the cache with --cascade_cache. Default: no limit')
+    argparser.add_argument(
+        '--cascade_cache_mb', type=float, default=CASCADE_CACHE_MB,
+        help='Memory bound of the cache in MB with --cascade_cache. Default: {0}'.format(CASCADE_CACHE_MB))
+    argparser.add_argument(
+        '--od_sampling', choices=[cons.OD_RANDOM, cons.OD_EXACT, cons.OD_FIXED], default=cons.OD_RANDOM,
+        help='Source and consumer nodes of the loads: {0} of each drawn at random in every evaluation ({1}), all of them ({2}), '
+        'or {0} of each in a fixed order, the same in every evaluation ({3}). Default: {1}'.format(
+            cons.OD_SAMPLES, cons.OD_RANDOM, cons.OD_EXACT, cons.OD_FIXED))
+    argparser.add_argument(
+        '--raw_samples',
+        help='File (.npy) in which the state of the consumer areas of every sample is stored (samples x areas, 0 ok and 1 blackout), '
+        'memory-mapped while the samples are simulated; with --importance_sampling, their weights are stored in <name>_weights.npy')
+    argparser.add_argument(
+        '--output_format', choices=sorted(OUTPUT_EXTENSIONS), default='geojson',
+        help='Format of the --output_file: the consumer areas with damage (geojson), or only their properties by area name (json) '
+        'or as a table (csv). Default: geojson')
+    argparser.add_argument(
+        '--stats_file',
+        help='File (.npz) in which the statistics of the samples are saved: disruption probabilities of the areas with their '
+        'standard errors, moments and histogram of the affected population')
+
+    return argparser
 
-    args = argparser.parse_args()
+# ANALYSIS OF ONE HAZARD SCENARIO
+# args: parsed arguments (see make_argument_parser); store: optional dict in which the analysis server keeps the imported exposure,
+# the fragility providers and the networks (see get_stored); timings: optional dict, filled with the duration (s) of the stages;
+# results: optional dict, filled with summary statistics of the scenario (see summarize_results). Returns the name of the output file
+def run_scenario(args,store=None,timings=None,results=None):
+    timings=timings if timings is not None else {}
+    total_start_time=time.time()
 
     prefixes_by_hazard = {
         'earthquake': 'EQ',
@@ -155,15 +494,22 @@ def main():
     #folder location
     folder_prefix = os.path.dirname(os.path.realpath(__file__))
     # Exposure data 
-    DamageNodes=import_json_to_dict(os.path.join(folder_prefix, country_prefix + '_EPN_ExposureNodes.geojson'))
-    ExposureLines=import_json_to_dict(os.path.join(folder_prefix, country_prefix + '_EPN_ExposureLines.geojson'))
-    ExposureConsumerAreas=import_json_to_dict(os.path.join(folder_prefix, country_prefix + '_EPN_ExposureConsumerAreas.geojson'))
+    nodes_file=os.path.join(folder_prefix, country_prefix + '_EPN_ExposureNodes.geojson')
+    lines_file=os.path.join(folder_prefix, country_prefix + '_EPN_ExposureLines.geojson')
+    # (with a store, the same dicts are used again: the fields added by the analysis are overwritten in every run)
+    start_time=time.time()
+    areas_file=os.path.join(folder_prefix, country_prefix + '_EPN_ExposureConsumerAreas.geojson')
+    DamageNodes=get_stored(store,'json',nodes_file,import_json_to_dict)
+    ExposureConsumerAreas=get_stored(store,'json',areas_file,import_json_to_dict)
+    timings['exposure']=time.time()-start_time
+
+    start_time=time.time()
 
     # if the hazard uses more than one intensity measure
     if args.hazard in ['lahar']:
         fragility_files = [os.path.join(folder_prefix, ffp + '_NetworkFragility.json') for ffp in fragility_file_prefix]
-        evaluate_ProbFailure_multiIntensity(fragility_files,im_file_list,DamageNodes)
-        NetworkFragility=import_json_to_dict(fragility_files[0])# sources and terminals do not depend on the intensity measure
+        evaluate_ProbFailure_multiIntensity(fragility_files,im_file_list,DamageNodes,args.interpolation,store)
+        network_fragility_file=fragility_files[0]# sources and terminals do not depend on the intensity measure
     else: #hazard with one single intensity measure
         
         if isinstance(im_file_list,list):
@@ -171,22 +517,175 @@ def main():
         if isinstance(fragility_file_prefix,list):
             fragility_file_prefix=fragility_file_prefix[0]   
         fragility_file = os.path.join(folder_prefix, fragility_file_prefix + '_NetworkFragility.json')
-        evaluate_ProbFailure_oneIntensity(fragility_file,im_file_list,DamageNodes)
-        NetworkFragility=import_json_to_dict(fragility_file)
-    
-    
-    
+        evaluate_ProbFailure_oneIntensity(fragility_file,im_file_list,DamageNodes,args.interpolation,store)
+        network_fragility_file=fragility_file
+    NetworkFragility=get_stored(store,'json',network_fragility_file,import_json_to_dict)
+    timings['probability_of_failure']=time.time()-start_time
+
+    # the lines are only read if the network is not in the cache
+    network_cache=None
+    if not args.no_cache:
+        cache_dir=args.cache_dir if args.cache_dir is not None else os.path.join(folder_prefix, 'network_cache')
+        network_cache=network_cache_file(cache_dir,country_prefix,[nodes_file,lines_file],NetworkFragility,seed=args.seed,store=store,
+                                         od_sampling=args.od_sampling)
 
     # execute main function
-    DamageConsumerAreas,SampleDamageNetwork = run_network_simulation(DamageNodes, ExposureLines, NetworkFragility, ExposureConsumerAreas)
+    DamageConsumerAreas,SampleStats = run_network_simulation(DamageNodes, lines_file, NetworkFragility, ExposureConsumerAreas, seed=args.seed, workers=args.workers,
+                                                                     nmcs=args.nmcs, adaptive=args.adaptive, batch_size=args.batch_size,
+                                                                     tol_prob=args.tol_prob, tol_population=args.tol_population, max_time=args.max_time,
+                                                                     network_cache=network_cache,store=store,timings=timings,
+                                                                     crn=args.crn,crn_file=args.crn_file,line_fragility=args.line_fragility,
+                                                                     importance_sampling=args.importance_sampling,
+                                                                     is_target_failures=args.is_target_failures,raw_samples=args.raw_samples,
+                                                                     cascade_cache=args.cascade_cache,cascade_cache_entries=args.cascade_cache_entries,
+                                                                     cascade_cache_mb=args.cascade_cache_mb,od_sampling=args.od_sampling)
+    if results is not None:
+        results.update(summarize_results(DamageConsumerAreas,SampleStats))
 
     if args.output_file is None:
-        output_filename = country_prefix + '_EPN_ExposureConsumerAreas_withDamage.geojson'
+        output_filename = country_prefix + '_EPN_ExposureConsumerAreas_withDamage' + OUTPUT_EXTENSIONS[args.output_format]
     else:
         output_filename = args.output_file
-    # save consumer areas output as geojson file
-    save_to_JSON(DamageConsumerAreas, os.path.join(folder_prefix, output_filename))
-    #make_histogram(SampleDamageNetwork)
+    # save consumer areas output as geojson file (or their properties only)
+    start_time=time.time()
+    template=None
+    if args.output_format=='geojson':
+        template=get_stored(store,'geojson_template',areas_file,lambda filename: make_geojson_template(ExposureConsumerAreas))
+    save_output(DamageConsumerAreas, os.path.join(folder_prefix, output_filename), args.output_format, template)
+    if args.stats_file is not None:
+        SampleStats.save(args.stats_file,area_names=[feature[cons.PROPERTIES][cons.AREA_NAME] for feature in DamageConsumerAreas[cons.FEATURES]])
+    timings['output']=time.time()-start_time
+    #make_histogram(SampleStats)
+
+    timings['total']=time.time()-total_start_time
+    return output_filename
+
+# SUMMARY OF A SCENARIO
+# number of samples (and effective number of samples, lower with importance sampling), mean and standard deviation of the affected population,
+# expected number of disrupted areas (sum of the disruption probabilities) and largest disruption probability of an area
+# with importance sampling, the moments are the weighted means of the samples (unbiased)
+def summarize_results(DamageConsumerAreas,SampleStats):
+    prob=[feature[cons.PROPERTIES][cons.AREA_POF] for feature in DamageConsumerAreas[cons.FEATURES]]
+    mean,std=SampleStats.population_moments()
+    return {
+        'n_samples':SampleStats.n,
+        'effective_samples':float(SampleStats.effective_samples()),
+        'mean_affected_population':float(mean),
+        'std_affected_population':float(std),
+        'expected_disrupted_areas':float(np.sum(prob)),
+        'max_prob_disruption':float(np.max(prob,initial=0.0))}
+
+# BATCH OF SCENARIOS
+# the manifest is a json file with a list of scenarios (or a dict with the list as "scenarios"). A scenario is a dict with a "name"
+# and the arguments of this script that differ from the command line ones, for example
+#   {"name": "VEI4", "hazard": "lahar", "intensity_file": ["VEI4_maxheight.xml", "VEI4_maxvelocity.xml"]}
+# intensity files (and common random number files) are relative to the folder of the manifest, output files (and raw sample and statistics files,
+# only if the scenario sets them) to the output folder (default output: <name>.geojson, or the extension of its output_format)
+# returns a list of (name, arguments) of the scenarios
+def read_manifest(args,output_dir):
+    manifest=import_json_to_dict(args.manifest)
+    if isinstance(manifest,dict):
+        manifest=manifest['scenarios']
+    manifest_dir=os.path.dirname(os.path.abspath(args.manifest))
+    scenarios=[]
+    for i,scenario in enumerate(manifest):
+        name=str(scenario.get('name','scenario_'+str(i)))
+        scenario_args=argparse.Namespace(**vars(args))
+        scenario_args.manifest=None
+        scenario_args.output_file=None
+        scenario_args.raw_samples=None
+        scenario_args.stats_file=None
+        for key,value in scenario.items():
+            if key=='name':
+                continue
+            if not hasattr(scenario_args,key) or key in ('manifest','output_dir'):
+                raise Exception('{0} is not a supported argument of the scenario {1}'.format(key,name))
+            setattr(scenario_args,key,value)
+        if isinstance(scenario_args.intensity_file,str):
+            scenario_args.intensity_file=[scenario_args.intensity_file]
+        scenario_args.intensity_file=[os.path.join(manifest_dir,f) for f in scenario_args.intensity_file or []]
+        if 'crn_file' in scenario and scenario['crn_file'] is not None:
+            scenario_args.crn_file=os.path.join(manifest_dir,scenario['crn_file'])
+        if scenario_args.output_file is None:
+            scenario_args.output_file=name+OUTPUT_EXTENSIONS[scenario_args.output_format]
+        scenario_args.output_file=os.path.join(output_dir,scenario_args.output_file)
+        if scenario_args.raw_samples is not None:
+            scenario_args.raw_samples=os.path.join(output_dir,scenario_args.raw_samples)
+        if scenario_args.stats_file is not None:
+            scenario_args.stats_file=os.path.join(output_dir,scenario_args.stats_file)
+        scenarios.append((name,scenario_args))
+    return scenarios
+
+# runs the scenarios of the manifest and writes the summary table; returns the number of failed scenarios
+# the network of each group of scenarios (same country, hazard, seed and OD sampling) is built once: the first scenario of each group runs
+# in this process and fills the store, which the worker processes inherit. With several workers, the samples of each
+# scenario are simulated in its worker process (workers=1 in the scenarios)
+def run_batch(args):
+    output_dir=args.output_dir if args.output_dir is not None else os.path.dirname(os.path.abspath(args.manifest))
+    os.makedirs(output_dir,exist_ok=True)
+    summary_file=args.output_file if args.output_file is not None else os.path.join(output_dir,'summary.csv')
+    scenarios=read_manifest(args,output_dir)
+    workers=args.workers
+    for name,scenario_args in scenarios:
+        scenario_args.workers=1 if workers>1 else scenario_args.workers
+
+    store={}
+    results={}
+    first,rest=[],[]
+    groups=set()
+    for i,(name,scenario_args) in enumerate(scenarios):
+        group=(scenario_args.country,scenario_args.hazard,scenario_args.seed,scenario_args.od_sampling)
+        (rest if group in groups else first).append(i)
+        groups.add(group)
+    for i in first:
+        results[i]=_run_batch_scenario(scenarios[i],store)
+    if workers>1 and len(rest)>1:
+        with multiprocessing.Pool(min(workers,len(rest)),initializer=_init_batch_worker,initargs=(store,)) as pool:
+            for i,result in zip(rest,pool.imap(_run_batch_scenario,[scenarios[i] for i in rest])):
+                results[i]=result
+    else:
+        for i in rest:
+            results[i]=_run_batch_scenario(scenarios[i],store)
+
+    fields=['name','country','hazard','status','output_file','n_samples','effective_samples','mean_affected_population','std_affected_population',
+            'expected_disrupted_areas','max_prob_disruption','time']
+    with open(summary_file,'w',newline='') as f:
+        writer=csv.DictWriter(f,fieldnames=fields,extrasaction='ignore')
+        writer.writeheader()
+        for i in range(0,len(scenarios)):
+            writer.writerow(results[i])
+    return sum(1 for result in results.values() if result['status']!='ok')
+
+# store of the worker processes of run_batch, set once by the pool initializer
+_batch_store=None
+
+def _init_batch_worker(store):
+    global _batch_store
+    _batch_store=store
+
+# runs one scenario of a batch; a failed scenario is reported in the summary, the other scenarios still run
+def _run_batch_scenario(scenario,store=None):
+    name,scenario_args=scenario
+    store=store if store is not None else _batch_store
+    timings={}
+    result={'name':name,'country':scenario_args.country,'hazard':scenario_args.hazard}
+    try:
+        result['output_file']=run_scenario(scenario_args,store=store,timings=timings,results=result)
+        result['status']='ok'
+    except Exception as e:
+        result['status']='error: '+str(e)
+        print('Scenario '+name+' failed: '+str(e))
+    result['time']=timings.get('total')
+    return result
+
+def main():
+    args = make_argument_parser().parse_args()
+    if args.manifest is not None:
+        failed=run_batch(args)
+        if failed>0:
+            raise SystemExit('{0} scenarios failed'.format(failed))
+    else:
+        run_scenario(args)
 
 if __name__ == '__main__':
     main()
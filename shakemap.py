@@ -5,15 +5,13 @@ This module contains classes to handle
 the access to shakemap data.
 '''
 
-import collections
-import io
 import math
-import tokenize
 
-import lxml.etree as le
 from lxml.etree import XMLParser
 import numpy as np
-from scipy.spatial import cKDTree
+
+# size of the blocks that are fed to the xml parser
+READ_BLOCK_SIZE = 1 << 20
 
 
 class TsunamiShakemap():
@@ -21,25 +19,21 @@ class TsunamiShakemap():
     Shakemap implementation for the tsunamis.
     '''
 
-    def __init__(self, root):
-        self._root = root
+    def __init__(self, content):
+        self._content = content
 
     def _find_grid_fields(self):
-        grid_fields = self._root.find(
-            'event').findall(
-                'grid_field')
-        return [ShakemapGridField(x) for x in grid_fields]
+        return [ShakemapGridField(x) for x in self._content.grid_fields]
 
     def _find_grid_data(self):
-        grid_data = self._root.find(
-            'event').find(
-                'grid_data')
-        return ShakemapGridData(grid_data)
+        return ShakemapGridData(self._content.grid_data)
 
-    def to_intensity_provider(self):
+    def to_intensity_provider(self, interpolation='nearest'):
         '''
         Returns an instance to access the data point
         that is closest to a given location.
+        The grid is irregular, so there is no interpolation
+        and a kd-tree is used for the search.
         '''
         grid_fields = self._find_grid_fields()
         grid_data = self._find_grid_data()
@@ -71,22 +65,136 @@ class Shakemaps():
     def from_file(file_name):
         '''
         Read the shakemap from an xml file.
+        The file is streamed through the parser, so that
+        neither the xml tree nor the text of the grid data
+        is kept in memory.
         '''
         huge_parser = XMLParser(
             encoding='utf-8',
             recover=True,
-            huge_tree=True
+            huge_tree=True,
+            target=ShakemapContentTarget()
         )
-        xml = le.parse(file_name, huge_parser)
-        root = xml.getroot()
+        with open(file_name, 'rb') as input_file:
+            for block in iter(lambda: input_file.read(READ_BLOCK_SIZE), b''):
+                huge_parser.feed(block)
+        content = huge_parser.close()
 
-        if Shakemaps._looks_like_tsunami_shakemap(root):
-            return TsunamiShakemap(root)
-        return EqShakemap(root)
+        if Shakemaps._looks_like_tsunami_shakemap(content.root_attrib):
+            return TsunamiShakemap(content)
+        return EqShakemap(content)
 
     @staticmethod
-    def _looks_like_tsunami_shakemap(root):
-        return root.get('shakemap_originator') == '_AWI_'
+    def _looks_like_tsunami_shakemap(root_attrib):
+        return root_attrib.get('shakemap_originator') == '_AWI_'
+
+
+class ShakemapContentTarget():
+    '''
+    Parser target that collects the parts of the shakemap
+    that are needed for the intensity provider:
+    attributes of the root element and of the grid specification,
+    the grid fields and the grid data (as a 2-D float array with
+    one column per grid field).
+    '''
+    def __init__(self):
+        self.root_attrib = None
+        self.grid_specification = None
+        self.grid_fields = []
+        self.grid_data = None
+        self._grid_data_reader = None
+
+    @staticmethod
+    def _local_name(tag):
+        return tag.rsplit('}', 1)[-1]
+
+    def start(self, tag, attrib):
+        '''
+        Called for each start tag.
+        '''
+        name = self._local_name(tag)
+        if self.root_attrib is None:
+            self.root_attrib = dict(attrib)
+        elif name == 'grid_specification':
+            self.grid_specification = dict(attrib)
+        elif name == 'grid_field':
+            self.grid_fields.append(dict(attrib))
+        elif name == 'grid_data':
+            self._grid_data_reader = GridDataReader()
+
+    def end(self, tag):
+        '''
+        Called for each end tag.
+        '''
+        if self._grid_data_reader is not None and self._local_name(tag) == 'grid_data':
+            self.grid_data = self._grid_data_reader.to_array(
+                len(self.grid_fields))
+            self._grid_data_reader = None
+
+    def data(self, data):
+        '''
+        Called for (chunks of) text content.
+        '''
+        if self._grid_data_reader is not None:
+            self._grid_data_reader.feed(data)
+
+    def close(self):
+        '''
+        Returns the collected content at the end of the parsing.
+        '''
+        if self.root_attrib is None:
+            self.root_attrib = {}
+        return self
+
+
+class GridDataReader():
+    '''
+    Reads the whitespace separated numbers of the grid data
+    from chunks of text.
+    The parser may give one chunk per line, so the chunks
+    are collected and parsed together once PARSE_SIZE
+    characters are pending.
+    '''
+
+    PARSE_SIZE = 1 << 20
+
+    def __init__(self):
+        self._blocks = []
+        self._chunks = []
+        self._pending_size = 0
+
+    def feed(self, text):
+        '''
+        Collects a chunk of the text, and reads all complete
+        numbers of the collected chunks once they are large enough.
+        '''
+        self._chunks.append(text)
+        self._pending_size += len(text)
+        if self._pending_size >= self.PARSE_SIZE:
+            self._parse()
+
+    def _parse(self):
+        # the last number may be continued in the next chunk,
+        # so it is kept back
+        text = ''.join(self._chunks)
+        last_space = max(text.rfind(' '), text.rfind('\n'), text.rfind('\t'), text.rfind('\r'))
+        rest = text[last_space + 1:]
+        self._chunks = [rest]
+        self._pending_size = len(rest)
+        if last_space >= 0:
+            self._blocks.append(np.fromstring(text[:last_space], sep=' '))
+
+    def to_array(self, n_fields):
+        '''
+        Returns the numbers as a 2-D array with one row per
+        grid point and one column per grid field.
+        '''
+        self._chunks.append(' ')
+        self._parse()
+        values = np.concatenate(self._blocks) if self._blocks else np.zeros(0)
+        # incomplete last rows are ignored
+        n_rows = len(values) // n_fields if n_fields > 0 else 0
+        return values[:n_rows * n_fields].reshape(n_rows, n_fields)
 
 
 class EqShakemap():
@@ -94,31 +202,32 @@ class EqShakemap():
     Class to handle the xml access to
     the shakemap xml elements.
     '''
-    def __init__(self, root):
-        self._root = root
+    def __init__(self, content):
+        self._content = content
 
     def _find_grid_fields(self):
-        grid_fields = self._root.findall(
-            '{http://earthquake.usgs.gov/eqcenter/shakemap}grid_field')
-        return [ShakemapGridField(x) for x in grid_fields]
+        return [ShakemapGridField(x) for x in self._content.grid_fields]
 
     def _find_grid_data(self):
-        grid_data = self._root.find(
-            '{http://earthquake.usgs.gov/eqcenter/shakemap}grid_data')
-        return ShakemapGridData(grid_data)
+        return ShakemapGridData(self._content.grid_data)
 
     def _find_lon_lat_spacing(self):
-        grid_specification = self._root.find(
-            '{http://earthquake.usgs.gov/eqcenter/shakemap}grid_specification')
+        grid_specification = self._content.grid_specification
         nominal_lat_spacing = grid_specification.get('nominal_lat_spacing')
         nominal_lon_spacing = grid_specification.get('nominal_lon_spacing')
 
         return float(nominal_lon_spacing), float(nominal_lat_spacing)
 
-    def to_intensity_provider(self):
+    def to_intensity_provider(self, interpolation='nearest'):
         '''
         Returns an instance to access the data point
         that is closest to a given location.
+        As the grid is regular, the row and column are
+        computed directly from the location (no spatial index).
+        With interpolation='bilinear' the values are
+        interpolated between the four surrounding grid points.
+        The kd-tree is only used if the points do not fit
+        on the regular grid.
         '''
         grid_fields = self._find_grid_fields()
         grid_data = self._find_grid_data()
@@ -127,8 +236,13 @@ class EqShakemap():
 
         max_dist = 6372.82 * math.sqrt(lon_spacing**2 + lat_spacing**2)*3.14159265359/180/2
 
-        return ShakemapIntensityProvider(
-            grid_fields, grid_data, 'LON', 'LAT', max_dist)
+        try:
+            return RegularGridIntensityProvider(
+                grid_fields, grid_data, 'LON', 'LAT',
+                lon_spacing, lat_spacing, max_dist, interpolation)
+        except IrregularGridError:
+            return ShakemapIntensityProvider(
+                grid_fields, grid_data, 'LON', 'LAT', max_dist)
 
 
 class ShakemapGridField():
@@ -136,42 +250,42 @@ class ShakemapGridField():
     Class to represent a shakemap
     grid field.
     '''
-    def __init__(self, xml):
-        self._xml = xml
+    def __init__(self, attrib):
+        self._attrib = attrib
 
     def get_index(self):
         '''
         Returns the index value of the field (one-based).
         '''
-        return self._xml.get('index')
+        return self._attrib.get('index')
 
     def get_name(self):
         '''
         Returns the name of the field.
         '''
-        return self._xml.get('name')
+        return self._attrib.get('name')
 
     def get_units(self):
         '''
         Returns the unit of the field.
         '''
-        return self._xml.get('units')
+        return self._attrib.get('units')
 
 
 class ShakemapGridData():
     '''
-    Class for the xml element with the grid data.
+    Class for the grid data.
     '''
-    def __init__(self, xml):
-        self._xml = xml
+    def __init__(self, values):
+        self._values = values
 
-    def get_text(self):
+    def get_values(self):
         '''
-        Returns the text of the data.
-        This is a tsv content without header (as this is in the
-        grid fields).
+        Returns the data as a 2-D float array, with one row per
+        grid point and one column per grid field (in the order
+        of the grid fields).
         '''
-        return self._xml.text
+        return self._values
 
 
 class ShakemapIntensityProvider():
@@ -188,31 +302,11 @@ class ShakemapIntensityProvider():
             max_dist):
         names = [x.get_name().upper() for x in grid_fields]
         units = {x.get_name().upper(): x.get_units() for x in grid_fields}
-        data = collections.defaultdict(list)
-        # it must be tokenized (because of xml processing the newlines
-        # may not be consistent)
-        tokens = tokenize.tokenize(
-            io.BytesIO(
-                grid_data.get_text().encode('utf-8')).readline)
-        index = 0
-        token_before = None
-        for token in tokens:
-            # 2 is number
-            if token.type == 2:
-                if index >= len(names):
-                    index = 0
-                name = names[index]
-                value = float(token.string)
-                if token_before is not None and token_before.string == '-':
-                    value = -1 * value
-                data[name].append(value)
-                index += 1
-            token_before = token
-        coords = np.array(
-            [
-                [data[lon_name][i],
-                 data[lat_name][i]]
-                for i in range(len(data[lon_name]))])
+        values = grid_data.get_values()
+        data = {name: values[:, i] for i, name in enumerate(names)}
+        coords = np.column_stack((data[lon_name], data[lat_name]))
+        # imported here, as only irregular grids need the spatial index
+        from scipy.spatial import cKDTree
         self._spatial_index = cKDTree(coords)
         self._names = names
         self._data = data
@@ -226,17 +320,204 @@ class ShakemapIntensityProvider():
         Returns all the data in a dict, as well as all the units.
         Both together are returned as a tuple.
         '''
-        coord = np.array([lon, lat])
-        dist, idx = self._spatial_index.query(coord, k=1)
+        data, units, _ = self.get_nearest_batch([lon], [lat])
+        data = {name: values[0] for name, values in data.items()}
+        data['Mdist'] = self._max_dist
+        return data, units
 
-        data = {}
+    def get_nearest_batch(self, lons, lats):
+        '''
+        Searches for the nearest values in the shakemap to
+        all the given lon lat locations with one query of the
+        spatial index.
+        Returns a dict with one array per field (and the distances
+        as 'dist'), the units and a boolean array that marks the
+        locations within the maximal distance (the values of the
+        other locations are 0).
+        '''
+        coords = np.column_stack((
+            np.asarray(lons, dtype=float), np.asarray(lats, dtype=float)))
+        dist, idx = self._spatial_index.query(coords, k=1)
+        mask = dist <= self._max_dist
 
+        data = {}
         for name in self._names:
-            if dist > self._max_dist:
-                value = 0
-            else:
-                value = self._data[name][idx]
-            data[name] = value
-            data['dist']=dist
-            data['Mdist']=self._max_dist
-        return data, self._units
\ No newline at end of file
+            data[name] = np.where(mask, self._data[name][idx], 0)
+        data['dist'] = dist
+        return data, self._units, mask
+
+class IrregularGridError(Exception):
+    '''
+    Exception for grid data whose points are not on
+    a regular grid.
+    '''
+
+
+class RegularGridIntensityProvider():
+    '''
+    Class to give access to the value of a regular grid
+    (as in the USGS shakemaps) at a given location.
+    The row and column are computed from the location,
+    the grid origin and the spacing; there is no spatial index.
+    The grid may be sparse (as the lahar grids, that only
+    contain the affected cells): a location whose grid point
+    is missing (with bilinear interpolation: whose four
+    surrounding points are missing) takes the nearest data
+    point within the maximal distance, as with the kd-tree of
+    ShakemapIntensityProvider. With bilinear interpolation,
+    the other missing points have value 0.
+    '''
+
+    # maximal distance of a data point to its grid position,
+    # relative to the spacing
+    TOLERANCE = 0.1
+
+    def __init__(
+            self,
+            grid_fields,
+            grid_data,
+            lon_name,
+            lat_name,
+            lon_spacing,
+            lat_spacing,
+            max_dist,
+            interpolation='nearest'):
+        if interpolation not in ('nearest', 'bilinear'):
+            raise Exception('Not supported interpolation: ' + str(interpolation))
+        names = [x.get_name().upper() for x in grid_fields]
+        values = grid_data.get_values()
+        lons = values[:, names.index(lon_name)]
+        lats = values[:, names.index(lat_name)]
+        if len(lons) == 0 or lon_spacing == 0 or lat_spacing == 0:
+            raise IrregularGridError('No regular grid')
+
+        # the origin is the north west grid point (rows go from north to south),
+        # taken from the data (the extent in the grid specification
+        # may be the one of the cell borders)
+        self._lon0 = lons.min()
+        self._lat0 = lats.max()
+        # exact spacing from the extent (the nominal one is rounded)
+        self._n_cols, self._lon_spacing = self._fit_axis(
+            lons.max() - self._lon0, abs(lon_spacing))
+        self._n_rows, self._lat_spacing = self._fit_axis(
+            self._lat0 - lats.min(), abs(lat_spacing))
+
+        cols = (lons - self._lon0) / self._lon_spacing
+        rows = (self._lat0 - lats) / self._lat_spacing
+        if len(cols) > 0 and max(
+                np.max(np.abs(cols - np.round(cols))),
+                np.max(np.abs(rows - np.round(rows)))) > self.TOLERANCE:
+            raise IrregularGridError('The points are not on a regular grid')
+
+        # index of the data point of each grid cell (-1 if there is no data)
+        self._cell_index = np.full(
+            (self._n_rows, self._n_cols), -1, dtype=np.int64)
+        self._cell_index[
+            np.round(rows).astype(np.int64),
+            np.round(cols).astype(np.int64)] = np.arange(len(lons))
+
+        self._names = names
+        self._values = values
+        self._units = {x.get_name().upper(): x.get_units() for x in grid_fields}
+        self._max_dist = max_dist
+        self._interpolation = interpolation
+        # spatial index of the data points, only built for locations
+        # at missing grid points of sparse grids
+        self._coords = np.column_stack((lons, lats))
+        self._spatial_index = None
+
+    @staticmethod
+    def _fit_axis(extent, nominal_spacing):
+        n_steps = int(round(extent / nominal_spacing))
+        if n_steps == 0:
+            return 1, nominal_spacing
+        return n_steps + 1, extent / n_steps
+
+    def _grid_values(self, rows, cols):
+        '''
+        Returns the values (one column per field) of the grid points
+        with the given rows and columns; 0 for missing points.
+        '''
+        idx = self._cell_index[rows, cols]
+        result = self._values[np.maximum(idx, 0)]
+        result[idx < 0] = 0
+        return result
+
+    def _lookup(self, lons, lats):
+        '''
+        Returns the values (one row per location, one column
+        per field) and the distances of the locations to the nearest
+        grid point.
+        '''
+        lons = np.asarray(lons, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        fcols = (lons - self._lon0) / self._lon_spacing
+        frows = (self._lat0 - lats) / self._lat_spacing
+        cols = np.clip(np.round(fcols), 0, self._n_cols - 1).astype(np.int64)
+        rows = np.clip(np.round(frows), 0, self._n_rows - 1).astype(np.int64)
+        dist = np.hypot(
+            lons - (self._lon0 + cols * self._lon_spacing),
+            lats - (self._lat0 - rows * self._lat_spacing))
+
+        if self._interpolation == 'nearest':
+            result = self._grid_values(rows, cols)
+            missing = self._cell_index[rows, cols] < 0
+        else:
+            col0 = np.clip(np.floor(fcols), 0, max(self._n_cols - 2, 0)).astype(np.int64)
+            row0 = np.clip(np.floor(frows), 0, max(self._n_rows - 2, 0)).astype(np.int64)
+            col1 = np.minimum(col0 + 1, self._n_cols - 1)
+            row1 = np.minimum(row0 + 1, self._n_rows - 1)
+            tcol = np.clip(fcols - col0, 0, 1)[:, np.newaxis]
+            trow = np.clip(frows - row0, 0, 1)[:, np.newaxis]
+            result = (
+                (1 - trow) * ((1 - tcol) * self._grid_values(row0, col0) +
+                              tcol * self._grid_values(row0, col1)) +
+                trow * ((1 - tcol) * self._grid_values(row1, col0) +
+                        tcol * self._grid_values(row1, col1)))
+            missing = np.all([
+                self._cell_index[r, c] < 0
+                for r, c in ((row0, col0), (row0, col1), (row1, col0), (row1, col1))], axis=0)
+        if np.any(missing):
+            dist[missing], idx = self._nearest_points(lons[missing], lats[missing])
+            result[missing] = self._values[idx]
+        result[dist > self._max_dist] = 0
+        return result, dist
+
+    def _nearest_points(self, lons, lats):
+        '''
+        Returns the distances and the indices of the nearest
+        data points to the locations.
+        '''
+        if self._spatial_index is None:
+            # imported here, as only sparse grids need the spatial index
+            from scipy.spatial import cKDTree
+            self._spatial_index = cKDTree(self._coords)
+        return self._spatial_index.query(np.column_stack((lons, lats)), k=1)
+
+    def get_nearest(self, lon, lat):
+        '''
+        Searches for the nearest value in the shakemap to
+        the given lon lat location (or the bilinear interpolation
+        of the surrounding values).
+        Returns all the data in a dict, as well as all the units.
+        Both together are returned as a tuple.
+        '''
+        data, units, _ = self.get_nearest_batch([lon], [lat])
+        data = {name: values[0] for name, values in data.items()}
+        data['Mdist'] = self._max_dist
+        return data, units
+
+    def get_nearest_batch(self, lons, lats):
+        '''
+        Searches for the nearest values (or the bilinear interpolations)
+        in the shakemap to all the given lon lat locations.
+        Returns a dict with one array per field (and the distances
+        as 'dist'), the units and a boolean array that marks the
+        locations within the maximal distance (the values of the
+        other locations are 0).
+        '''
+        values, dist = self._lookup(lons, lats)
+
+        data = {name: values[:, i] for i, name in enumerate(self._names)}
+        data['dist'] = dist
+        return data, self._units, dist <= self._max_dist
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the network simulation steps of Netsim, on small networks built in memory.
+Run from the root folder of the repository: python -m unittest discover -s tests
+
+@author: hfrv2
+"""
+
+import unittest
+
+import numpy as np
+
+import Constants as cons
+import Netcore
+import Netsim as ns
+
+
+def consumer_areas(names):
+    return {cons.FEATURES: [{cons.PROPERTIES: {cons.AREA_NAME: name, cons.AREA_POPULATION: 1}} for name in names]}
+
+
+class ConsumerIncidenceTest(unittest.TestCase):
+
+    def test_line_from_the_area_node_to_itself(self):
+        # source s, consumer a with a line to s and a line from a to a
+        net = Netcore.Network(['s', 'a'], ['source', cons.CONSUMER], [0, 1], [1, 1])
+        area_nodes, incidence, n_supply = ns.consumer_incidence(consumer_areas(['a']), net)
+        self.assertEqual(area_nodes.tolist(), [1])
+        self.assertEqual(incidence.toarray().tolist(), [[1.0, 1.0]])
+        self.assertEqual(n_supply.tolist(), [2])
+        # mean damage of the two supply lines: (0.75+1)/2, below the critical damage
+        net.edge_dam[:] = [0.75, 1.0]
+        self.assertEqual(ns.set_state_consumers(consumer_areas(['a']), net).tolist(), [0])
+        net.edge_dam[:] = [0.85, 1.0]
+        self.assertEqual(ns.set_state_consumers(consumer_areas(['a']), net).tolist(), [1])
+
+    def test_supply_lines_in_adjacency_order(self):
+        # star around node 0, areas at the center and at a leaf
+        net = Netcore.Network(['c', 'x', 'y', 'z'], [cons.CONSUMER] * 4, [0, 0, 0], [3, 1, 2])
+        area_nodes, incidence, n_supply = ns.consumer_incidence(consumer_areas(['c', 'y']), net)
+        self.assertEqual(area_nodes.tolist(), [0, 2])
+        self.assertEqual(incidence.indices.tolist(), net.incident_edges(0).tolist() + net.incident_edges(2).tolist())
+        self.assertEqual(n_supply.tolist(), [3, 1])
+
+
+class ODBetweennessTest(unittest.TestCase):
+
+    def test_loads_of_the_shortest_paths(self):
+        # line 0-1-2-3 with a shortcut 0-2 longer than 0-1-2, and node 4 without lines
+        net = Netcore.Network(['a', 'b', 'c', 'd', 'e'], ['source', 'x', cons.CONSUMER, cons.CONSUMER, cons.CONSUMER],
+                              [0, 1, 2, 0], [1, 2, 3, 2])
+        net.edge_weight[:] = [1.0, 1.0, 1.0, 3.0]
+        # paths 0-1-2 and 0-1-2-3 (4 is not reachable, the source is not its own consumer), plus 1 for every component
+        node_loads, edge_loads = ns.OD_betweenness_centrality(net, [0], [2, 3, 4, 0], normalized=False)
+        self.assertEqual(node_loads.tolist(), [3.0, 3.0, 3.0, 2.0, 1.0])
+        self.assertEqual(edge_loads.tolist(), [3.0, 3.0, 2.0, 1.0])
+        # with the line 1-2 removed, the paths take the shortcut
+        net.edge_weight[1] = 1 / cons.EPS
+        node_loads, edge_loads = ns.OD_betweenness_centrality(net, [0], [2, 3], normalized=False)
+        self.assertEqual(node_loads.tolist(), [3.0, 1.0, 3.0, 2.0, 1.0])
+        self.assertEqual(edge_loads.tolist(), [1.0, 1.0, 2.0, 3.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
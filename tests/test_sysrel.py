@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the Monte Carlo simulation of Sysrel, on a small network built in memory.
+Run from the root folder of the repository: python -m unittest discover -s tests
+
+@author: hfrv2
+"""
+
+import unittest
+
+import numpy as np
+
+import Constants as cons
+import Netcore
+import Sysrel as sr
+
+
+def ring_network(n_nodes=8, pof=0.0):
+    '''
+    Ring of n_nodes nodes with one source (node 0) and consumers at the other nodes, each with a consumer area,
+    and its source, terminal and consumer area lists.
+    '''
+    taxonomy = ['source'] + [cons.CONSUMER] * (n_nodes - 1)
+    edge_from = np.arange(n_nodes)
+    edge_to = (edge_from + 1) % n_nodes
+    net = Netcore.Network(['n' + str(i) for i in range(n_nodes)], taxonomy, np.minimum(edge_from, edge_to),
+                          np.maximum(edge_from, edge_to))
+    net.node_pof[1:] = pof
+    s_nodes = [0]
+    t_nodes = list(range(1, n_nodes))
+    areas = {cons.FEATURES: [
+        {cons.PROPERTIES: {cons.AREA_NAME: 'n' + str(i), cons.AREA_POPULATION: 10}} for i in t_nodes]}
+    sr.evaluate_system_loads(net, s_nodes, t_nodes, seed=0)
+    sr.assign_initial_capacities(net, 1.5)
+    return net, s_nodes, t_nodes, areas
+
+
+class SampleChunksTest(unittest.TestCase):
+
+    def test_chunk_sizes_are_bounded(self):
+        for workers in (1, 4):
+            for mcs in (1, 50, 10**4, 10**6):
+                chunks = sr.sample_chunks(7, mcs, workers)
+                self.assertLessEqual(max(len(chunk) for chunk in chunks), sr.MAX_CHUNK_SIZE)
+                # all the samples, in order
+                self.assertEqual([i for chunk in chunks for i in chunk], list(range(7, 7 + mcs)))
+
+    def test_a_few_chunks_per_worker(self):
+        self.assertEqual(len(sr.sample_chunks(0, 400, 5)), 20)
+
+
+class AdaptiveSimulationTest(unittest.TestCase):
+
+    def test_no_disruption_does_not_stop_at_first_batch(self):
+        # true disruption probability 0: no component can fail
+        net, s_nodes, t_nodes, areas = ring_network()
+        stats = sr.run_adaptive_Monte_Carlo_simulation(net, s_nodes, t_nodes, areas, batch_size=20, max_samples=400,
+                                                       tol_prob=0.01, tol_population=0.05, seed=1)
+        self.assertTrue(np.all(stats.prob() == 0))
+        # the relative error of the population is undefined without disruptions: the sample budget is used
+        self.assertEqual(stats.n, 400)
+
+    def test_prob_standard_errors_without_disruptions(self):
+        net, s_nodes, t_nodes, areas = ring_network()
+        stats = sr.run_Monte_Carlo_simulation(net, s_nodes, t_nodes, areas, 20, seed=1)
+        se_prob = sr.prob_standard_errors(stats)
+        # the upper bound of the Wilson interval of 0 disruptions in 20 samples
+        self.assertTrue(np.allclose(se_prob * cons.Z_95, cons.Z_95**2 / (20 + cons.Z_95**2)))
+        self.assertTrue(np.all(se_prob > 0.01))
+        # enough samples for the upper bound to fall below 1.96*0.01
+        stats = sr.run_Monte_Carlo_simulation(net, s_nodes, t_nodes, areas, 200, seed=1)
+        self.assertTrue(np.all(sr.prob_standard_errors(stats) <= 0.01))
+
+    def test_stops_once_the_tolerances_are_met(self):
+        net, s_nodes, t_nodes, areas = ring_network(pof=0.5)
+        stats = sr.run_adaptive_Monte_Carlo_simulation(net, s_nodes, t_nodes, areas, batch_size=20, max_samples=400,
+                                                       tol_prob=0.2, tol_population=0.5, seed=1)
+        self.assertLess(stats.n, 400)
+        self.assertTrue(np.all(sr.prob_standard_errors(stats) <= 0.2))
+
+
+if __name__ == '__main__':
+    unittest.main()